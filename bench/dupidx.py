@@ -0,0 +1,76 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time the enumeration (or concatenation) of duplicate headwords on a
+synthetic database of N entries whose words are drawn from a vocabulary of
+RATIO * N words (0.5: about 85% of the entries are ambiguous, 5: about 18%):
+
+    python bench/dupidx.py [N] [RATIO] [enumerate|cat]
+
+Run it on the parent commit of a change to compare.
+"""
+
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+from dictmaster.plugin import BasePlugin
+from dictmaster.util import data_hash
+
+def main(n, ratio, method):
+    rnd = random.Random(1)
+    words = ["w%d%s" % (i, rnd.choice(["", "é", " x", "Ab"])) for i in range(max(1, int(n * ratio)))]
+    with tempfile.TemporaryDirectory() as dirname:
+        plugin = BasePlugin(dirname)
+        conn = sqlite3.connect(plugin.output_db)
+        conn.executemany("INSERT INTO dict(word,def,rawid) VALUES (?,?,0)", (
+            (rnd.choice(words), "d%d" % i) for i in range(n)
+        ))
+        # older databases have no def_hash
+        if "def_hash" in [row[1] for row in conn.execute("PRAGMA table_info(dict)")]:
+            conn.create_function("data_hash", 1, data_hash)
+            conn.execute("UPDATE dict SET def_hash = data_hash(def)")
+        # leave some gaps in the ids
+        conn.execute("DELETE FROM dict WHERE id % 97 = 0")
+        conn.executemany("INSERT INTO synonyms(wid,syn) VALUES (?,?)", (
+            (rnd.randint(1, n), rnd.choice(words)) for _ in range(n // 3)
+        ))
+        conn.commit()
+        ambiguous = conn.execute('''
+            SELECT COUNT(*) FROM dict
+            WHERE word IN (SELECT word FROM dict GROUP BY word HAVING COUNT(*) > 1)
+        ''').fetchone()[0]
+        total = conn.execute("SELECT COUNT(*) FROM dict").fetchone()[0]
+        conn.close()
+
+        plugin._conn = sqlite3.connect(plugin.output_db)
+        plugin._c = plugin._conn.cursor()
+        t_start = time.perf_counter()
+        getattr(plugin, "dupidx_" + method)()
+        plugin._conn.commit()
+        elapsed = time.perf_counter() - t_start
+        plugin._conn.close()
+    print("dupidx_{}: {} entries, {:.0f}% ambiguous: {:.2f} s".format(
+        method, total, 100 * ambiguous / total, elapsed
+    ))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.5,
+         sys.argv[3] if len(sys.argv) > 3 else "enumerate")
@@ -0,0 +1,70 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Download N pages from a local stub server (see stub_server.py) with both
+fetcher engines and print pages/s and the number of TCP connections:
+
+    python bench/fetch.py [N] [LATENCY_MS]
+"""
+
+import sys
+import time
+import sqlite3
+import tempfile
+
+from stub_server import serve, StubHandler
+
+from dictmaster.util import FLAGS
+from dictmaster.plugin import BasePlugin
+from dictmaster.stages.fetcher import Fetcher
+
+def main(n, latency):
+    server = serve(latency)
+    port = server.server_address[1]
+
+    class StubFetcher(Fetcher):
+        class FetcherThread(Fetcher.FetcherThread):
+            def parse_uri(self, uri):
+                return "http://127.0.0.1:{}/{}".format(port, uri)
+
+    for engine, kwargs in (("threads", {}), ("async", {"concurrency": 100})):
+        with tempfile.TemporaryDirectory() as dirname:
+            plugin = BasePlugin(dirname)
+            conn = sqlite3.connect(plugin.output_db)
+            conn.executemany("INSERT INTO raw(uri,flag) VALUES (?,?)",
+                             [(str(i), FLAGS["RAW_FETCHER"]) for i in range(n)])
+            conn.commit()
+            conn.close()
+            fetcher = StubFetcher(plugin, engine=engine, **kwargs)
+            StubHandler.connections = 0
+            t_start = time.perf_counter()
+            fetcher.start()
+            fetcher.join()
+            elapsed = time.perf_counter() - t_start
+            conn = sqlite3.connect(plugin.output_db)
+            fetched = conn.execute(
+                "SELECT COUNT(*) FROM raw WHERE flag & ?", (FLAGS["FETCHED"],)
+            ).fetchone()[0]
+            conn.close()
+        print("{:8s} {}: {} pages in {:.2f} s = {:.0f} pages/s, {} TCP connections".format(
+            engine, kwargs, fetched, elapsed, fetched / elapsed, StubHandler.connections
+        ))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02)
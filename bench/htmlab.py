@@ -0,0 +1,52 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time HtmlABProcessor.do_html on a single list of li/li pairs, as found on
+the Factbook pages:
+
+    python bench/htmlab.py [PAIRS ...]
+
+Run it on the parent commit of a change to compare.
+"""
+
+import sys
+import time
+
+from lxml import etree
+from pyquery import PyQuery as pq
+
+from dictmaster.stages.processor import HtmlABProcessor
+
+def main(sizes):
+    for npairs in sizes:
+        html = '<html><body><ul class="expandcollapse">{}</ul></body></html>'.format("".join(
+            "<li><h2>Field {0}</h2></li><li><div>value {0}</div></li>".format(i)
+            for i in range(npairs)
+        ))
+        doc = pq(etree.fromstring(html.encode(), parser=etree.HTMLParser(encoding="utf-8")))
+        proc = HtmlABProcessor.__new__(HtmlABProcessor)
+        proc.AB = ("li", "li")
+        proc._canceled = False
+        pairs = []
+        proc.append = lambda dt, dd: pairs.append(dt)
+        t_start = time.perf_counter()
+        proc.do_html(doc("ul.expandcollapse"))
+        elapsed = time.perf_counter() - t_start
+        print("{:6d} pairs: {:9.1f} ms ({} appended)".format(npairs, elapsed * 1000, len(pairs)))
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [100, 400, 5000, 50000])
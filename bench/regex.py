@@ -0,0 +1,79 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Time the substitution tables of the plugins with RegexPipeline against a
+loop over re.sub on synthetic input of each plugin's markup:
+
+    python bench/regex.py
+"""
+
+import re
+import timeit
+
+from dictmaster.plugins.gcide import GcideProcessor
+from dictmaster.plugins.dwds import DWDSFetcher, DWDSProcessor
+from dictmaster.plugins.etymonline import EtymonlineProcessor
+from dictmaster.plugins.dwb import DwbProcessor
+from dictmaster.plugins.zeno import ZenoProcessor
+
+CASES = [
+    ("gcide pre_html", GcideProcessor.pre_html_regex, 200,
+     "<p><hw>Ab*a`cus</hw> <pr>(\\'8ab\\'b7<ait>a</ait>*k<ucr/s)</pr>, <pos>n.</pos>"
+     " <ety>[L. <ets>abacus</ets>, <grk>'a`bax</grk>]</ety> <sn>1.</sn>"
+     " <def>A table <as>as in the phrases <er>counting table</er></as>.</def>"
+     " <mark>[Obs.]</mark> <!a comment!> <source>[1913 Webster]</source></p>\n"),
+    ("gcide strip_quotes", GcideProcessor.strip_quotes, 1, "Ab*a`cus's \"x\""),
+    ("dwds pre_html", DWDSFetcher.FetcherThread.pre_html_regex, 200,
+     '<div class="dwdswb-lesart"><!-- Bedeutung --><span class="dwdswb-definition">'
+     'Haus</span> <!-- Beispiel --><span>das Haus am See</span></div> '),
+    ("dwds definition", DWDSProcessor.definition_regex, 20,
+     "<span>↗Haus</span>  ;  <span>Gebäude</span>   mit  Dach ; "),
+    ("etymonline pre_html", EtymonlineProcessor.pre_html_regex, 40,
+     '<section>&#13;\n<p>from Latin\xa0"table, board"&#13;</p><blockquote>text'
+     ' "with quotes" here\n[Chaucer]\n</blockquote></section>\n'),
+    ("zeno term", ZenoProcessor.term_regex, 1, "Abacus; [2] "),
+    ("dwb pre_html", DwbProcessor.pre_html_regex, 150,
+     '<div class="dwb-sense-n">1)</div> <span class="&#10; dwb-italics dwb-hi">'
+     'abacus</span>\n <span class="dwb-author"><a href="/x">Goethe</a></span>'
+     ' <a name="a1"></a><a href="/wb/dwb/haus">Haus</a>'
+     ' <i class="bi bi-arrow-up-right"></i> <span title="zum Eintrag im'
+     ' DWB-Quellenverzeichnis"  data-toggle="tooltip">x</span>\n'),
+]
+
+def loop_sub(rules, string):
+    for pattern, repl in rules:
+        string = re.sub(pattern, repl, string)
+    return string
+
+def measure(fun, number=None):
+    timer = timeit.Timer(fun)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(5, number)) / number * 1e6
+
+def plugins():
+    for name, pipeline, repeat, sample in CASES:
+        string = sample * repeat
+        assert pipeline.sub(string) == loop_sub(pipeline.rules, string)
+        loop = measure(lambda: loop_sub(pipeline.rules, string))
+        piped = measure(lambda: pipeline.sub(string))
+        print("{:20s} {:6d} chars {:9.1f} us -> {:9.1f} us".format(
+            name, len(string), loop, piped))
+
+if __name__ == "__main__":
+    plugins()
@@ -0,0 +1,373 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import http.client as httplib
+import random
+import ssl
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from dictmaster.util import URL_HEADER, ACCEPT_ENCODING, warn_nl, decode_content, \
+                            parse_retry_after, RetriesExhausted, NotModified, ConnectionPool
+
+DEFAULT_CONCURRENCY = 100
+MAX_REDIRECTS = 10
+
+class HttpStatusError(Exception):
+    def __init__(self, url, code):
+        super().__init__(f"HTTP Error {code}")
+        self.url, self.code = url, code
+
+class AsyncHttpClient(object):
+    """
+    A minimal HTTP/1.1 client on top of asyncio streams that keeps idle
+    connections open and reuses them for subsequent requests to the same host.
+
+    Proxies are not supported, see `use_proxy`. Such downloads are left to
+    the blocking `fallback` pool, whose transferred bytes are included in
+    `received` and `decoded`.
+    """
+    pool_size = DEFAULT_CONCURRENCY
+    requests = 0
+    reused = 0
+    fallback = None
+
+    _received = 0
+    _decoded = 0
+    _idle = None
+    _slots = None
+    _ssl_context = None
+    _proxies = None
+
+    def __init__(self, pool_size=DEFAULT_CONCURRENCY):
+        self.pool_size = pool_size
+        self._idle = {}
+        self._slots = {}
+        self._ssl_context = ssl.create_default_context()
+        self._proxies = urllib.request.getproxies()
+        self.fallback = ConnectionPool(size=pool_size)
+
+    @property
+    def received(self):
+        return self._received + self.fallback.received
+
+    @property
+    def decoded(self):
+        return self._decoded + self.fallback.decoded
+
+    def use_proxy(self, url):
+        """ Whether `url` has to go through a proxy (http_proxy etc.) """
+        parts = urllib.parse.urlsplit(url)
+        return parts.scheme in self._proxies \
+            and not urllib.request.proxy_bypass(parts.netloc)
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            return await asyncio.open_connection(
+                host, port, ssl=self._ssl_context, server_hostname=host
+            )
+        return await asyncio.open_connection(host, port)
+
+    async def _read_body(self, reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    # skip trailer
+                    while (await reader.readline()).strip():
+                        pass
+                    break
+                body += await reader.readexactly(size)
+                await reader.readline()
+            return bytes(body), True
+        if "content-length" in headers:
+            size = int(headers["content-length"])
+            return await reader.readexactly(size), True
+        return await reader.read(), False
+
+    async def _roundtrip(self, conn, key, method, path, body, headers):
+        reader, writer = conn
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {key[1]}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        writer.write(request + (body or b""))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by remote host")
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        resp_headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            k, v = line.split(":", 1)
+            resp_headers[k.strip().lower()] = v.strip()
+        if method == "HEAD" or int(status) in (204, 304):
+            data, reusable = b"", True
+        else:
+            data, reusable = await self._read_body(reader, resp_headers)
+        reusable = reusable and version == "HTTP/1.1" \
+            and resp_headers.get("connection", "").lower() != "close"
+        return int(status), resp_headers, data, reusable
+
+    async def request(self, url, data=None, timeout=60, headers=None):
+        """ Return (status, headers, body), following redirects """
+        extra_headers = headers or {}
+        for _ in range(MAX_REDIRECTS):
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            headers = dict(URL_HEADER, **extra_headers)
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
+            headers["Connection"] = "keep-alive"
+            method = "GET"
+            if data is not None:
+                method = "POST"
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+                headers["Content-Length"] = str(len(data))
+            result = await asyncio.wait_for(
+                self._request_pooled(key, method, path, data, headers),
+                timeout
+            )
+            status, resp_headers, body = result
+            if status in (301, 302, 303, 307, 308) and "location" in resp_headers:
+                url = urllib.parse.urljoin(url, resp_headers["location"])
+                if status == 303 or (status in (301, 302) and method == "POST"):
+                    data = None
+                continue
+            if body:
+                received = len(body)
+                body = decode_content(body, resp_headers.get("content-encoding"))
+                self._received += received
+                self._decoded += len(body)
+            return status, resp_headers, body
+        raise HttpStatusError(url, status)
+
+    async def _request_pooled(self, key, method, path, body, headers):
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(self.pool_size)
+            self._idle[key] = []
+        async with self._slots[key]:
+            idle = self._idle[key]
+            reused = len(idle) > 0
+            self.requests += 1
+            self.reused += int(reused)
+            conn = idle.pop() if reused else await self._connect(key)
+            try:
+                try:
+                    result = await self._roundtrip(conn, key, method, path, body, headers)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # stale keep-alive connection, retry on a fresh one
+                    conn[1].close()
+                    conn = await self._connect(key)
+                    result = await self._roundtrip(conn, key, method, path, body, headers)
+            except BaseException:
+                conn[1].close()
+                raise
+            status, resp_headers, data, reusable = result
+            if reusable:
+                idle.append(conn)
+            else:
+                conn[1].close()
+            return status, resp_headers, data
+
+    async def close(self):
+        for idle in self._idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self._idle = {}
+        # semaphores are bound to the event loop they were first used in
+        self._slots = {}
+
+class AsyncFetchEngine(object):
+    """
+    Runs the download part of a Fetcher stage in a single asyncio event loop.
+
+    Plugin hooks (`parse_uri`, `filter_data`, `store_filtered`) are called on
+    one FetcherThread instance that is never started as a thread. Since
+    `filter_data` may be CPU-bound (or even download more data), it is run
+    in a small thread pool to keep the event loop responsive.
+
+    Downloads that have to go through a proxy (and other schemes than http(s))
+    are left to the blocking `download_retry` of the FetcherThread in that
+    thread pool, which hands them to urllib. The FetcherThread is expected to
+    use the client's `fallback` pool.
+    """
+    concurrency = DEFAULT_CONCURRENCY
+
+    _fthread = None
+    _client = None
+    _executor = None
+
+    def __init__(self, fthread, concurrency=DEFAULT_CONCURRENCY, client=None):
+        self._fthread = fthread
+        self.concurrency = concurrency
+        self._client = client
+
+    def run(self):
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        try:
+            asyncio.run(self._main())
+        finally:
+            self._executor.shutdown(wait=True)
+
+    async def _main(self):
+        if self._client is None:
+            self._client = AsyncHttpClient(pool_size=self.concurrency)
+        uris = iter(self._fthread.uris)
+        workers = [self._worker(uris) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            await self._client.close()
+
+    async def _worker(self, uris):
+        loop = asyncio.get_running_loop()
+        fthread = self._fthread
+        controller = fthread.controller
+        for rawid, uri in uris:
+            if fthread._canceled:
+                break
+            # before the next await, so that the digests are looked up in order
+            stored = fthread.stored(rawid)
+            slot = None
+            if controller is not None:
+                slot = controller.slot()
+                if not await self._acquire(slot):
+                    return
+            try:
+                try:
+                    data = await self.download_retry(
+                        fthread.parse_uri(uri), fthread.postdata, stored=stored, slot=slot
+                    )
+                finally:
+                    if slot is not None:
+                        slot.release()
+                if fthread._canceled:
+                    break
+                data = await loop.run_in_executor(
+                    self._executor, fthread.filter_data, data, uri
+                )
+                # the FetcherThread's state is only touched by the loop thread
+                fthread.store_filtered(rawid, uri, data)
+            except NotModified:
+                fthread.keep(rawid, uri)
+            except RetriesExhausted as e:
+                fthread.defer(rawid, uri, e.retry_after)
+            if fthread.pause is not None:
+                await asyncio.sleep(random.uniform(*fthread.pause))
+
+    async def _acquire(self, slot):
+        """ Wait for a worker slot, return False if the fetcher is canceled """
+        while not slot.try_acquire():
+            if self._fthread._canceled:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def download_retry(self, url, params=None, timeout=60, stored=None, slot=None):
+        """ Async counterpart of CancelableThread.download_retry """
+        fthread = self._fthread
+        loop = asyncio.get_running_loop()
+        if not url.startswith(("http://", "https://")) or self._client.use_proxy(url):
+            return await loop.run_in_executor(
+                self._executor,
+                lambda: fthread.download_retry(url, params, stored=stored, slot=slot)
+            )
+        policy = fthread.retry_policy
+        cache = fthread.cache if params is None else None
+        cache_headers, cached = {}, None
+        if cache is not None:
+            cache_headers, cached = await loop.run_in_executor(
+                self._executor, cache.validators, url, stored
+            )
+        conditional = len(cache_headers) > 0
+        attempt = 0
+        while not fthread._canceled:
+            attempt += 1
+            if fthread.limiter is not None:
+                sleep_time = fthread.limiter.reserve(url)
+                while sleep_time > 0 and not fthread._canceled:
+                    await asyncio.sleep(min(sleep_time, 1))
+                    sleep_time -= 1
+                if fthread._canceled:
+                    break
+            t_start = time.monotonic()
+            retry_after, action = None, "retry"
+            try:
+                status, headers, data = await self._client.request(
+                    url, params, timeout, headers=cache_headers
+                )
+                fthread.report(status, t_start)
+                if status == 304 and conditional:
+                    cache.not_modified()
+                    if cached is None:
+                        raise NotModified(url)
+                    return cached
+                if status >= 400:
+                    action = policy.action(status)
+                    if action == "skip":
+                        reason = httplib.responses.get(status, "HTTP Error")
+                        warn_nl(f"{reason} ({status}): {url}")
+                        return b""
+                    retry_after = parse_retry_after(headers.get("retry-after"))
+                    raise HttpStatusError(url, status)
+                if cache is not None:
+                    await loop.run_in_executor(
+                        self._executor, cache.store, url, headers.get("etag"),
+                        headers.get("last-modified"), data
+                    )
+                return data
+            except NotModified:
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    fthread.report("timeout", t_start)
+                elif not isinstance(e, HttpStatusError):
+                    fthread.report("error", t_start)
+                if isinstance(e, (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError)):
+                    warn_str = f"Connection to {url} failed. "
+                else:
+                    warn_str = f"Error on {url}: '{e}'. "
+                sleep_time = None
+                if action != "defer":
+                    sleep_time = policy.delay(attempt, fthread.sleep, retry_after)
+                if sleep_time is None:
+                    warn_nl(warn_str + "Postponed to the next round.")
+                    raise RetriesExhausted(url, retry_after) from e
+                warn_nl(warn_str + f"Retrying in {sleep_time:.1f} sec...")
+                if slot is not None:
+                    slot.release()
+                while sleep_time > 0:
+                    if fthread._canceled:
+                        return None
+                    await asyncio.sleep(min(sleep_time, 1))
+                    sleep_time -= 1
+                if slot is not None and not await self._acquire(slot):
+                    return None
+        return None
@@ -0,0 +1,109 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+
+class HttpCache(object):
+    """
+    On-disk cache of the ETag and Last-Modified headers of downloaded pages.
+    Pages are revalidated with conditional requests, so that a page is only
+    transferred again if it has changed.
+
+    By default, the pages themselves are not cached, only a digest of the data
+    that was stored for them in the raw table: a page that didn't change is
+    simply left as it is in there. With `keep_bodies`, the pages are cached,
+    too, so that they can be revalidated after a reset of the plugin data.
+
+    The cache lives in its own database so that it survives a reset of the
+    plugin data. Shared by all fetcher threads.
+    """
+    db_file = ""
+    keep_bodies = False
+    requests = 0
+    unchanged = 0
+
+    _conn = None
+    _lock = None
+
+    def __init__(self, db_file, keep_bodies=False):
+        self.db_file = db_file
+        self.keep_bodies = keep_bodies
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                digest BLOB,
+                data BLOB
+            )
+        ''')
+
+    def validators(self, url, stored=None):
+        """
+        Return headers for a conditional request of `url` and the cached page.
+        If the page isn't cached, a conditional request only makes sense if
+        `stored`, the digest of the data stored for `url`, is still up to date.
+        """
+        with self._lock:
+            self.requests += 1
+            row = self._conn.execute('''
+                SELECT etag, last_modified, digest, data FROM cache WHERE url=?
+            ''', (url,)).fetchone()
+        if row is None:
+            return {}, None
+        etag, last_modified, digest, data = row
+        if data is None and (stored is None or stored != digest):
+            return {}, None
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers, data
+
+    def not_modified(self):
+        with self._lock:
+            self.unchanged += 1
+
+    def store(self, url, etag, last_modified, data):
+        """ Remember the validators of `url` (and `data` with keep_bodies) """
+        if etag is None and last_modified is None:
+            return
+        with self._lock:
+            self._conn.execute('''
+                INSERT OR REPLACE INTO cache (url, etag, last_modified, digest, data)
+                VALUES (?,?,?,NULL,?)
+            ''', (url, etag, last_modified, data if self.keep_bodies else None))
+
+    def set_digest(self, url, digest):
+        """ Record the digest of the data that was stored for `url` """
+        with self._lock:
+            self._conn.execute('''
+                UPDATE cache SET digest=? WHERE url=?
+            ''', (digest, url))
+
+    def progress(self):
+        return "unchanged: {} of {}".format(self.unchanged, self.requests)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -4,6 +4,8 @@ import signal
 import argparse
 
 from dictmaster.util import load_plugin
+from dictmaster.stages.fetcher import Fetcher
+from dictmaster.stardict import DICTZIP_CHUNK_SIZE
 
 last_broadcast_msg = " "
 def broadcast(msg, overwrite=False):
@@ -28,18 +30,78 @@ def cli_main():
                     help=("Discard data from last time."))
     parser.add_argument('--force-process', action="store_true", default=False,
                     help=("Discard processed data from last time (keep fetched data)."))
+    parser.add_argument('--refetch', action="store_true", default=False,
+                    help=("Download the pages again, but keep them until they are replaced."))
     parser.add_argument('-o', '--output', action="store", default="", type=str,
                     help=("Work and output directory."))
+    parser.add_argument('--engine', action="store", default=None,
+                    choices=["threads", "async"],
+                    help=("Download engine for the fetcher stages."))
+    parser.add_argument('--concurrency', action="store", default=None, type=int,
+                    help=("Number of parallel downloads (async engine only)."))
+    parser.add_argument('--pool-size', action="store", default=None, type=int,
+                    help=("Number of keep-alive connections per host."))
+    parser.add_argument('--rate-limit', action="store", default=None, type=float,
+                    help=("Maximum number of requests per second and host."))
+    parser.add_argument('--burst', action="store", default=1, type=int,
+                    help=("Number of requests allowed in a burst (with --rate-limit)."))
+    parser.add_argument('--http-cache', action="store_true", default=False,
+                    help=("Only download pages again if they changed since they were fetched."))
+    parser.add_argument('--http-cache-bodies', action="store_true", default=False,
+                    help=("Like --http-cache, but keep the pages, too (needed with --reset)."))
+    parser.add_argument('--adaptive', action="store_true", default=False,
+                    help=("Adapt the number of parallel downloads to the remote host."))
+    parser.add_argument('--max-threads', action="store", default=None, type=int,
+                    help=("Upper bound for the number of threads with --adaptive."))
+    parser.add_argument('--processes', action="store", default=None, type=int,
+                    help=("Number of processes for the processor stage "
+                          "(plugins that read a single dictionary file run in one process)."))
+    parser.add_argument('--dictzip-chunk-size', action="store", default=None, type=int,
+                    help=("Chunk size of the compressed .dict.dz file (smaller chunks: faster lookups, bigger file). "
+                          "At most 32762 chunks are possible, i.e. about 1.9 GB at the default size, "
+                          "bigger .dict files are left uncompressed."))
+    parser.add_argument('--dictzip-workers', action="store", default=None, type=int,
+                    help=("Number of threads compressing the .dict.dz file."))
     args = parser.parse_args()
+    if args.dictzip_chunk_size is not None \
+       and not 0 < args.dictzip_chunk_size <= DICTZIP_CHUNK_SIZE:
+        parser.error("--dictzip-chunk-size must be between 1 and {}".format(DICTZIP_CHUNK_SIZE))
 
     plugin = load_plugin(args.plugin, popts=args.popts, dirname=args.output)
     if plugin == None:
          sys.exit("Plugin not found or plugin broken.")
     plugin.force_process = args.force_process
+    if args.rate_limit is not None:
+        plugin.set_rate_limit(args.rate_limit, args.burst)
+    if args.http_cache or args.http_cache_bodies:
+        plugin.enable_http_cache(keep_bodies=args.http_cache_bodies)
+    if args.dictzip_chunk_size is not None:
+        plugin.dictzip_chunk_size = args.dictzip_chunk_size
+    if args.dictzip_workers is not None:
+        plugin.dictzip_workers = args.dictzip_workers
+    if args.processes is not None and plugin.stages["Processor"] is not None:
+        plugin.stages["Processor"].processes = args.processes
+    for stage in plugin.stages.values():
+        if not isinstance(stage, Fetcher):
+            continue
+        if args.engine is not None:
+            stage.engine = args.engine
+        if args.concurrency is not None:
+            stage.concurrency = args.concurrency
+        if args.pool_size is not None:
+            stage.pool_size = args.pool_size
+        if args.adaptive:
+            stage.adaptive = True
+        if args.max_threads is not None:
+            stage.max_threadcnt = args.max_threads
 
     if args.reset:
         broadcast("Resetting plugin data in '{}'.".format(plugin.output_directory))
         plugin.reset()
+    elif args.refetch:
+        if plugin.stages['Fetcher'] is not None:
+            plugin.stages['Fetcher'].reset()
+        plugin.stages['Processor'].reset()
     elif args.force_process:
         plugin.stages['Processor'].reset()
 
@@ -18,9 +18,14 @@ import os
 import shutil
 import sqlite3
 
-from pyglossary.glossary import Glossary
+from dictmaster.util import mkdir_p, CancelableThread, FLAGS, remove_accents, data_hash, \
+                            RateLimiter
+from dictmaster.cache import HttpCache
+from dictmaster.stardict import StarDictWriter, sort_key, DICTZIP_CHUNK_SIZE
 
-from dictmaster.util import mkdir_p, CancelableThread, FLAGS, remove_accents
+# UPDATE ... FROM is only supported as of SQLite 3.33, older versions get
+# correlated subqueries instead
+UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
 
 class BasePlugin(CancelableThread):
     stages = {
@@ -34,13 +39,36 @@ class BasePlugin(CancelableThread):
     output_db = ""
     dictname = ""
     enumerate = True
+    # number of concatenated definitions written back at once by dupidx_cat
+    cat_batch_size = 500
+    # compress the .dict file of the StarDict export (.dict.dz) in chunks of
+    # dictzip_chunk_size bytes on dictzip_workers threads (default: all CPUs)
+    dictzip = True
+    dictzip_chunk_size = DICTZIP_CHUNK_SIZE
+    dictzip_workers = None
+    # (requests per second, burst) per host, shared by all fetcher threads
+    rate_limit = None
+    rate_limiter = None
+    # cache of downloaded pages for conditional requests (survives reset)
+    http_cache = None
 
     def __init__(self, dirname, popts=[]):
         super().__init__()
         self.output_directory = dirname
         self.output_db = os.path.join(dirname, "db.sqlite")
+        if self.rate_limit is not None:
+            self.set_rate_limit(*self.rate_limit)
         self.setup()
 
+    def set_rate_limit(self, rate, burst=1):
+        self.rate_limit = (rate, burst)
+        self.rate_limiter = RateLimiter(rate, burst)
+
+    def enable_http_cache(self, keep_bodies=False):
+        cache_dir = os.path.join(self.output_directory, "cache")
+        mkdir_p(cache_dir)
+        self.http_cache = HttpCache(os.path.join(cache_dir, "http.sqlite"), keep_bodies)
+
     def setup(self):
         mkdir_p(os.path.join(self.output_directory, "raw"))
         mkdir_p(os.path.join(self.output_directory, "zip"))
@@ -53,21 +81,24 @@ class BasePlugin(CancelableThread):
                     id INTEGER PRIMARY KEY,
                     uri TEXT,
                     data TEXT,
-                    flag INTEGER
+                    flag INTEGER,
+                    data_hash BLOB
                 )
             ''');
             for i, f in enumerate([1, 4, 5, 8, 9, 16, 17, 154]):
                 c.execute(f"CREATE INDEX raw_flag_{i}_idx ON raw (flag & {f})")
             c.execute("CREATE INDEX raw_uri_idx ON raw (uri)")
-            c.execute("CREATE INDEX raw_data_idx ON raw (data)")
+            c.execute("CREATE INDEX raw_data_hash_idx ON raw (data_hash)")
             c.execute('''
                 CREATE TABLE dict (
                     id INTEGER PRIMARY KEY,
                     word TEXT,
                     def TEXT,
-                    rawid INTEGER
+                    rawid INTEGER,
+                    def_hash BLOB
                 )
             ''');
+            c.execute("CREATE INDEX dict_word_def_hash_idx ON dict (word, def_hash)")
             c.execute('''
                 CREATE TABLE synonyms (
                     id INTEGER PRIMARY KEY,
@@ -89,9 +120,34 @@ class BasePlugin(CancelableThread):
             self.post_setup(c)
             conn.commit()
             conn.close()
+        else:
+            self.upgrade_db()
 
     def post_setup(self, cursor): pass
 
+    def upgrade_db(self):
+        """ Migrate databases created by older versions of dictmaster """
+        conn = sqlite3.connect(self.output_db)
+        c = conn.cursor()
+        columns = [row[1] for row in c.execute("PRAGMA table_info(raw)")]
+        if "data_hash" not in columns:
+            conn.create_function("data_hash", 1, data_hash)
+            c.execute("ALTER TABLE raw ADD COLUMN data_hash BLOB")
+            c.execute("UPDATE raw SET data_hash = data_hash(data) WHERE data IS NOT NULL")
+            c.execute("DROP INDEX IF EXISTS raw_data_idx")
+            c.execute("CREATE INDEX raw_data_hash_idx ON raw (data_hash)")
+            conn.commit()
+            # reclaim the space of the dropped full-text index
+            c.execute("VACUUM")
+        columns = [row[1] for row in c.execute("PRAGMA table_info(dict)")]
+        if "def_hash" not in columns:
+            conn.create_function("data_hash", 1, data_hash)
+            c.execute("ALTER TABLE dict ADD COLUMN def_hash BLOB")
+            c.execute("UPDATE dict SET def_hash = data_hash(def)")
+            c.execute("CREATE INDEX dict_word_def_hash_idx ON dict (word, def_hash)")
+            conn.commit()
+        conn.close()
+
     def set_name(self, name, cursor=None):
         self.dictname = name
 
@@ -110,7 +166,14 @@ class BasePlugin(CancelableThread):
 
     def reset(self):
         if os.path.exists(self.output_directory):
-            shutil.rmtree(self.output_directory)
+            for name in os.listdir(self.output_directory):
+                path = os.path.join(self.output_directory, name)
+                if name == "cache":
+                    continue
+                elif os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
         self.setup()
 
     def progress(self):
@@ -174,25 +237,34 @@ class BasePlugin(CancelableThread):
             INSERT INTO TempDict (id, MaxId)
             SELECT k.id, q.MaxId
             FROM dict k
-            JOIN (SELECT MAX(d.id) as MaxId, d.word, d.def
+            JOIN (SELECT MAX(d.id) as MaxId, d.word, d.def_hash
                   FROM dict d
-                  GROUP BY d.word,d.def) q
+                  GROUP BY d.word,d.def_hash
+                  HAVING COUNT(*) > 1) q
             ON q.word = k.word
-            AND q.def = k.def
+            AND q.def_hash = k.def_hash
+            WHERE k.id <> q.MaxId
         ''')
         affected = self._c.execute('''
-            SELECT COUNT(*) FROM TempDict WHERE MaxId <> id
+            SELECT COUNT(*) FROM TempDict
         ''').fetchone()[0]
         self._status = "Removing {} duplicate entries...".format(affected)
-        self._c.execute('''
-            UPDATE synonyms
-            SET wid = (SELECT MaxId
-                       FROM TempDict d
-                       WHERE d.id = synonyms.wid)
-        ''')
+        if UPDATE_FROM:
+            self._c.execute('''
+                UPDATE synonyms
+                SET wid = d.MaxId
+                FROM TempDict d
+                WHERE d.id = synonyms.wid
+            ''')
+        else:
+            self._c.execute('''
+                UPDATE synonyms
+                SET wid = (SELECT d.MaxId FROM TempDict d WHERE d.id = synonyms.wid)
+                WHERE wid IN (SELECT id FROM TempDict)
+            ''')
         self._c.execute('''
             DELETE FROM dict
-            WHERE id NOT IN (SELECT MaxId FROM TempDict)
+            WHERE id IN (SELECT id FROM TempDict)
         ''')
         self._c.execute('''DROP TABLE TempDict''');
         self._status = "Done removing duplicate entries ({} entries affected).".format(affected)
@@ -208,89 +280,144 @@ class BasePlugin(CancelableThread):
 
     def dupidx_enumerate(self):
         """ Enumerate all dict entries for each term """
-        lines = self._c.execute('''SELECT id, word FROM dict''')
-        data = {}
-        for entry in lines:
-            if entry[1] not in data:
-                 data[entry[1]] = []
-            data[entry[1]].append(entry[0])
-        no = len(data.keys())
-        for i,key in enumerate(data.keys()):
-            dups = data[key]
-            self._status = "Enumerating ambivalent entries %d of %d..." % (i,no)
-            if len(dups) > 1:
-                self._c.executemany('''
-                    INSERT INTO synonyms(wid,syn)
-                    VALUES (?,?)
-                ''', [(wid,key) for wid in dups])
-                self._c.executemany('''
-                    UPDATE dict
-                    SET word=?
-                    WHERE id=?
-                ''', [("%s(%d)" % (key, j + 1), wid) for j, wid in enumerate(dups)])
+        self._status = "Enumerating ambivalent entries..."
+        self._c.execute('''
+            CREATE TEMP TABLE TempDups AS
+            SELECT id, word,
+                   ROW_NUMBER() OVER (PARTITION BY word ORDER BY id) AS n
+            FROM dict
+            WHERE word IN (SELECT word FROM dict
+                           GROUP BY word HAVING COUNT(*) > 1)
+            ORDER BY id
+        ''')
+        affected = self._c.execute('''SELECT COUNT(*) FROM TempDups''').fetchone()[0]
+        self._status = "Enumerating {} ambivalent entries...".format(affected)
+        self._c.execute('''
+            INSERT INTO synonyms(wid,syn)
+            SELECT id, word FROM TempDups
+        ''')
+        if UPDATE_FROM:
+            self._c.execute('''
+                UPDATE dict
+                SET word = t.word || '(' || t.n || ')'
+                FROM TempDups t
+                WHERE t.id = dict.id
+            ''')
+        else:
+            self._c.execute('''CREATE INDEX TempDups_id_idx ON TempDups (id)''')
+            self._c.execute('''
+                UPDATE dict
+                SET word = (SELECT t.word || '(' || t.n || ')'
+                            FROM TempDups t WHERE t.id = dict.id)
+                WHERE id IN (SELECT id FROM TempDups)
+            ''')
+        self._c.execute('''DROP TABLE TempDups''')
+        self._status = "Done enumerating ambivalent entries ({} entries affected).".format(affected)
 
     def dupidx_cat(self):
         """ Concatenate all dict entries for each term """
-        lines = self._c.execute('''SELECT id, word, def FROM dict''')
-        data = {}
-        for entry in lines:
-            if entry[1] not in data:
-                data[entry[1]] = {
-                    "id": entry[0],
-                    "def": entry[2],
-                    "dups": []
-                }
-            else:
-                data[entry[1]]["dups"].append(entry[0])
-                data[entry[1]]["def"] += entry[2]
-        no = len(data.keys())
-        for i,key in enumerate(data.keys()):
-            value = data[key]
-            self._status = "Concatenating ambivalent entries %d of %d..." % (i,no)
-            if len(value["dups"]) > 0:
-                self._c.executemany('''
-                    DELETE FROM dict WHERE id=?
-                ''', [(d,) for d in value["dups"]])
+        self._status = "Concatenating ambivalent entries..."
+        self._c.execute('''
+            CREATE TEMP TABLE TempDups AS
+            SELECT id, MIN(id) OVER (PARTITION BY word) AS FirstId
+            FROM dict
+            WHERE word IN (SELECT word FROM dict
+                           GROUP BY word HAVING COUNT(*) > 1)
+            ORDER BY FirstId, id
+        ''')
+        no = self._c.execute('''
+            SELECT COUNT(*) FROM TempDups WHERE id = FirstId
+        ''').fetchone()[0]
+        # stream the definitions of each term in id order, keeping only one
+        # concatenated definition and one batch of updates in memory
+        lines = self._conn.execute('''
+            SELECT t.FirstId, d.def
+            FROM TempDups t
+            JOIN dict d ON d.id = t.id
+            ORDER BY t.rowid
+        ''')
+        updates, parts, curr, i = [], [], None, 0
+        for first_id, definition in lines:
+            if first_id != curr:
+                if parts:
+                    definition_cat = "".join(parts)
+                    updates.append((definition_cat, data_hash(definition_cat), curr))
+                parts, curr, i = [], first_id, i + 1
+                self._status = "Concatenating ambivalent entries %d of %d..." % (i,no)
+            parts.append(definition)
+            if len(updates) >= self.cat_batch_size:
                 self._c.executemany('''
-                    UPDATE synonyms
-                    SET wid=?
-                    WHERE wid=?
-                ''', [(value["id"],d) for d in value["dups"]])
-                self._c.execute('''
-                    UPDATE dict
-                    SET def=?
-                    WHERE id=?
-                ''', (value["def"],value["id"]))
+                    UPDATE dict SET def=?, def_hash=? WHERE id=?
+                ''', updates)
+                updates = []
+        if parts:
+            definition_cat = "".join(parts)
+            updates.append((definition_cat, data_hash(definition_cat), curr))
+        self._c.executemany('''
+            UPDATE dict SET def=?, def_hash=? WHERE id=?
+        ''', updates)
+        if UPDATE_FROM:
+            self._c.execute('''
+                UPDATE synonyms
+                SET wid = t.FirstId
+                FROM TempDups t
+                WHERE t.id = synonyms.wid AND t.id <> t.FirstId
+            ''')
+        else:
+            self._c.execute('''CREATE INDEX TempDups_id_idx ON TempDups (id)''')
+            self._c.execute('''
+                UPDATE synonyms
+                SET wid = (SELECT t.FirstId FROM TempDups t WHERE t.id = synonyms.wid)
+                WHERE wid IN (SELECT id FROM TempDups WHERE id <> FirstId)
+            ''')
+        self._c.execute('''
+            DELETE FROM dict
+            WHERE id IN (SELECT id FROM TempDups WHERE id <> FirstId)
+        ''')
+        self._c.execute('''DROP TABLE TempDups''')
+        self._status = "Done concatenating ambivalent entries ({} terms affected).".format(no)
 
     def export(self):
-        fname = os.path.join(self.output_directory, "stardict.ifo")
+        """ Stream the dict and synonyms tables into a StarDict dictionary """
+        basename = os.path.join(self.output_directory, "stardict")
         with sqlite3.connect(self.output_db) as conn:
-            c = conn.cursor()
-            info = {}; data = []
-            for row in c.execute('''SELECT key,value FROM info''').fetchall():
+            conn.create_function("stardict_key", 1, sort_key, deterministic=True)
+            info = {}
+            for row in conn.execute('''SELECT key,value FROM info''').fetchall():
                 info[row[0]]=row[1]
-            c.execute('''SELECT word,def,id FROM dict''')
-            rows = c.fetchall()
-            no = len(rows)
-            syns = c.execute('''SELECT syn,wid FROM synonyms''').fetchall()
-            syn_list = {wid: [] for word, definition, wid in rows}
-            [syn_list[wid].append(syn) for syn, wid in syns]
-            if "sametypesequence" in info:
-                defiFormat = info["sametypesequence"]
-            else:
-                defiFormat = "h"
+            self._status = "Sorting entries..."
+            conn.execute('''
+                CREATE TEMP TABLE StarDictOrder AS
+                SELECT id FROM dict
+                ORDER BY stardict_key(word), word, id
+            ''')
+            no = conn.execute('''SELECT COUNT(*) FROM StarDictOrder''').fetchone()[0]
+
+            def entries():
+                lines = conn.execute('''
+                    SELECT d.word, d.def
+                    FROM StarDictOrder t
+                    JOIN dict d ON d.id = t.id
+                    ORDER BY t.rowid
+                ''')
+                for i, row in enumerate(lines):
+                    self._status = "Writing entry %d of %d..." % (i,no)
+                    yield row
 
-            # this command should only be called once
-            if Glossary.plugins == {}:
-                Glossary.init()
+            def synonyms():
+                self._status = "Writing synonyms..."
+                yield from conn.execute('''
+                    SELECT s.syn, t.rowid - 1
+                    FROM synonyms s
+                    JOIN StarDictOrder t ON t.id = s.wid
+                    ORDER BY stardict_key(s.syn), s.syn, t.rowid, s.id
+                ''')
 
-            g = Glossary()
-            for i, (word, definition, wid) in enumerate(rows):
-                self._status = "Reading from db entry %d of %d..." % (i,no)
-                g.addEntryObj(g.newEntry(
-                    [word] + syn_list[wid],
-                    definition,
-                    defiFormat=defiFormat))
-            self._status = "Writing to output file..."
-            g.setInfo("bookname", info["bookname"])
-            g.write(fname, "Stardict")
+            writer = StarDictWriter(
+                basename, info["bookname"],
+                sametypesequence=info.get("sametypesequence", "h"),
+                dictzip=self.dictzip,
+                dictzip_chunk_size=self.dictzip_chunk_size,
+                dictzip_workers=self.dictzip_workers)
+            writer.write(entries(), synonyms())
+            conn.execute('''DROP TABLE StarDictOrder''')
@@ -15,9 +15,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import sys
 from pyquery import PyQuery as pq
 
-from dictmaster.util import html_container_filter, FLAGS
+from dictmaster.util import html_container_filter, FLAGS, RetriesExhausted
 from dictmaster.plugin import BasePlugin
 from dictmaster.stages.fetcher import Fetcher
 from dictmaster.stages.processor import HtmlContainerProcessor
@@ -69,16 +70,19 @@ class Plugin(BasePlugin):
     def setup_session(self):
         if self.acadfran_vars is not None:
             return
-        url = "%s/showps.exe?p=main.txt;host=interface_academie8.txt;java=no;" % BASE_URL
-        session_id = self.download_retry(url).decode(CHARSET)
-        session_id = session_id.replace("\n"," ").replace("\r","")
-        session_id = re.sub(r".*;s=([0-9]*);.*", r"\1", session_id)
-        url = "%s/cherche.exe?680;s=%s;;" % (BASE_URL, session_id)
-        postdata = b"var0=&var2=%2A&var3=%2A%21%21%2A&var5=%2A%21%21%2A"
-        #{ "var0" : "", "var2" : "*", "var3" : "*!!*", "var5" : "*!!*" }
+        try:
+            url = "%s/showps.exe?p=main.txt;host=interface_academie8.txt;java=no;" % BASE_URL
+            session_id = self.download_retry(url).decode(CHARSET)
+            session_id = session_id.replace("\n"," ").replace("\r","")
+            session_id = re.sub(r".*;s=([0-9]*);.*", r"\1", session_id)
+            url = "%s/cherche.exe?680;s=%s;;" % (BASE_URL, session_id)
+            postdata = b"var0=&var2=%2A&var3=%2A%21%21%2A&var5=%2A%21%21%2A"
+            #{ "var0" : "", "var2" : "*", "var3" : "*!!*", "var5" : "*!!*" }
+            result = self.download_retry(url, postdata).decode(CHARSET)
+        except RetriesExhausted as e:
+            sys.exit("Could not open a session ({}), try again later.".format(e))
         wordcount, r_var = re.sub(
-            r".*;t=([0-9]+);r=([0-9]+);.*", r"\1,\2",
-            self.download_retry(url, postdata).decode(CHARSET)
+            r".*;t=([0-9]+);r=([0-9]+);.*", r"\1,\2", result
         ).split(",")
         wordcount, r_var = int(wordcount), int(r_var)
         self.acadfran_vars = {
@@ -80,39 +80,38 @@ class DwbFetcher(Fetcher):
             return f"https://www.dwds.de/wb/dwb/{uri}"
 
 class DwbProcessor(HtmlContainerProcessor):
+    pre_html_regex = RegexPipeline([
+        [' +title="zum Eintrag im DWB-Quellenverzeichnis"', " "],
+        [' +data-toggle="tooltip"', " "],
+        [' +data-placement="bottom"', " "],
+        ['<div class="dwb-sense-n"></div>', ""],
+        [r" *\n *", r" "],
+        [r'<i class="[^"]*bi-arrow-up-right[^"]*"/?>([^<]*</i>)?', ""],
+        [r'<span class="(?:&#10;)? *dwb-italics dwb-hi">([^<]*)</span>', r"<i>\1</i>"],
+        [r'<span class="(?:&#10;)? *dwb-title">([^<]*)</span>', r"<i>\1</i>"],
+        [
+            r'<span class="(?:&#10;)? *dwb-author"><a +href="[^"]*">([^<]*)</a></span>',
+            r'<span style="font-variant: small-caps">\1</span>',
+        ],
+        [
+            r'<span class="(?:&#10;)? *dwb-caps dwb-hi">([^<]*)</span>',
+            r'<span style="font-variant: small-caps">\1</span>',
+        ],
+        [r'<div class="dwb-sense-n">([^<]+)</div>', r"<b>\1</b>"],
+        [r'<a name="[^"]*"></a>', r""],
+        [r'<a href="/wb/dwb/([^"]+)">([^<]+)</a>', r'<a href="bword://\1">\2</a>'],
+    ])
+
     def do_pre_html(self, data):
         # For performance reasons, we manipulate via regular expressions, and avoid
         # DOM-manipulations if possible.
-        repl = []
         for term in ["D", "versteck-"]:
             if f'<a name="{term}"' in data:
-                repl.append((
+                data = data.replace(
                     '<div class="dwb-head"><span class="dwb-form"/></div>',
                     f'<div class="dwb-head"><span class="dwb-form">{term}</span></div>',
-                ))
-        repl += [
-            (' +title="zum Eintrag im DWB-Quellenverzeichnis"', " "),
-            (' +data-toggle="tooltip"', " "),
-            (' +data-placement="bottom"', " "),
-            ('<div class="dwb-sense-n"></div>', ""),
-            (r" *\n *", r" "),
-            (r'<i class="[^"]*bi-arrow-up-right[^"]*"/?>([^<]*</i>)?', ""),
-            (r'<span class="(?:&#10;)? *dwb-italics dwb-hi">([^<]*)</span>', r"<i>\1</i>"),
-            (r'<span class="(?:&#10;)? *dwb-title">([^<]*)</span>', r"<i>\1</i>"),
-            (
-                r'<span class="(?:&#10;)? *dwb-author"><a +href="[^"]*">([^<]*)</a></span>',
-                r'<span style="font-variant: small-caps">\1</span>',
-            ),
-            (
-                r'<span class="(?:&#10;)? *dwb-caps dwb-hi">([^<]*)</span>',
-                r'<span style="font-variant: small-caps">\1</span>',
-            ),
-            (r'<div class="dwb-sense-n">([^<]+)</div>', r"<b>\1</b>"),
-            (r'<a name="[^"]*"></a>', r""),
-            (r'<a href="/wb/dwb/([^"]+)">([^<]+)</a>', r'<a href="bword://\1">\2</a>'),
-        ]
-        for pattern, subst in repl:
-            data = re.sub(pattern, subst, data)
+                )
+        data = self.pre_html_regex.sub(data)
 
         return data
 
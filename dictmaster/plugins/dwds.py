@@ -14,7 +14,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import re
 import os
 import sys
 
@@ -65,6 +64,10 @@ class Plugin(BasePlugin):
 
 class DWDSFetcher(Fetcher):
     class FetcherThread(Fetcher.FetcherThread):
+        pre_html_regex = RegexPipeline([
+            [r"<!--.*?-->", ""],
+        ])
+
         def filter_data(self, data, uri):
             if data == None or len(data) < 2:
                  return None
@@ -75,12 +78,7 @@ class DWDSFetcher(Fetcher):
             ):
                 return None
             data = " ".join(data.split())
-            repl = [ ]
-            for r in repl: data = data.replace(r[0], r[1])
-            regex = [
-                [r"<!--.*?-->", ""],
-            ]
-            for r in regex: data = re.sub(r[0], r[1], data)
+            data = self.pre_html_regex.sub(data)
             parser = etree.HTMLParser(encoding="utf-8")
             doc = pq(etree.fromstring(data, parser=parser))
             return doc("div.row:nth-child(2) div.col-md-12").html()
@@ -91,16 +89,23 @@ class DWDSFetcher(Fetcher):
             "https://www.dwds.de/wb/%s" % (uri,)
 
 class DWDSProcessor(HtmlContainerProcessor):
+    alts_regex = RegexPipeline([
+        [r" ([0-9]+)$",r""],
+    ])
+    definition_regex = RegexPipeline([
+        ["↗",r""],
+        [r" +",r" "],
+        [r"\s*;\s*$",r""],
+        [r"\s+;\s+",r"; "],
+    ])
+
     def __init__(self, plugin):
         super().__init__("", plugin, singleton=True)
         self.do_html_definition = getattr(self, "do_html_definition_%s"%plugin.panelid)
         self.do_html_alts = getattr(self, "do_html_alts_%s"%plugin.panelid)
 
     def do_html_term(self, doc):
-        term = doc("h1.dwdswb-ft-lemmaansatz b").eq(0).text().strip()
-        regex = [ ]
-        for r in regex: term = re.sub(r[0], r[1], term)
-        return term
+        return doc("h1.dwdswb-ft-lemmaansatz b").eq(0).text().strip()
 
     def do_html_alts_1(self, dt_html, html, term): return []
 
@@ -109,11 +114,7 @@ class DWDSProcessor(HtmlContainerProcessor):
         alts = doc("div.etymwb-entry").prev("div")
         alts = sum([doc(a).text().split("·") for a in alts], [])
         alts = [a.strip() for a in alts]
-        regex = [
-            [r" ([0-9]+)$",r""],
-        ]
-        for r in regex: alts = [re.sub(r[0],r[1],a) for a in alts]
-        return alts
+        return [self.alts_regex.sub(a) for a in alts]
 
     def do_html_definition_1(self, dt_html, html, term):
         doc = pq(html)
@@ -211,14 +212,7 @@ class DWDSProcessor(HtmlContainerProcessor):
                 .removeAttr("onclick").removeAttr("data-id")
 
         html = " ".join(doc("body").html().strip().split())
-        regex = [
-            ["↗",r""],
-            [r" +",r" "],
-            [r"\s*;\s*$",r""],
-            [r"\s+;\s+",r"; "],
-        ]
-        for r in regex: html = re.sub(r[0],r[1],html)
-        return html
+        return self.definition_regex.sub(html)
 
     def do_html_definition_2(self, html, term):
         doc = pq(html)("h2#etymwb > div")
@@ -14,7 +14,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import re
 import sqlite3
 from string import ascii_lowercase as ALPHA
 from pyquery import PyQuery as pq
@@ -79,28 +78,26 @@ class EtymonlineFetcher(Fetcher):
             return "http://www.etymonline.com/search?%s"%uri
 
 class EtymonlineProcessor(HtmlContainerProcessor):
+    pre_html_regex = RegexPipeline([
+        ["&#13;", ""],
+        ["\xa0", " "],
+        [r'\[([^\]]+)\]\n</blockquote>',
+         r'<p class="src">[\1]</p></blockquote>'],
+        [r'([^=])"([^> ][^"]*[^= ])"([^>])',
+         r'\1<span class="meaning">"\2"</span>\3']
+    ])
+    alts_regex = RegexPipeline([
+        [r" +\([^\)]+\)$",r""],
+    ])
+
     def do_pre_html(self, data):
-        data = data.replace("&#13;", "")
-        data = data.replace("\xa0", " ")
-        regex = [
-            [r'\[([^\]]+)\]\n</blockquote>',
-             r'<p class="src">[\1]</p></blockquote>'],
-            [r'([^=])"([^> ][^"]*[^= ])"([^>])',
-             r'\1<span class="meaning">"\2"</span>\3']
-        ]
-        for r in regex: data = re.sub(r[0], r[1], data)
-        return data
+        return self.pre_html_regex.sub(data)
 
     def do_html_term(self, doc):
         return doc("a.word__name--TTbAA").eq(0).text().strip()
 
     def do_html_alts(self, dt_html, doc, term):
-        regex = [
-            [r" +\([^\)]+\)$",r""],
-        ]
-        for r in regex:
-            term_stripped = re.sub(r[0], r[1], term)
-        return [term, term_stripped]
+        return [term, self.alts_regex.sub(term)]
 
     def do_html_definition(self, dt_html, html, term):
         doc = pq(html)("section.word__defination--2q7ZH")
@@ -19,7 +19,7 @@ import sys
 
 from pyquery import PyQuery as pq
 
-from dictmaster.util import FLAGS
+from dictmaster.util import FLAGS, RetriesExhausted, warn_nl
 from dictmaster.plugin import BasePlugin
 from dictmaster.stages.fetcher import Fetcher
 from dictmaster.stages.processor import HtmlContainerProcessor
@@ -134,7 +134,11 @@ class Plugin(BasePlugin):
             flag_path = os.path.join(res_dirname, flag_file)
             flag_url = "http://folkets-lexikon.csc.kth.se/folkets/grafik/"+flag_file
             if not os.path.exists(flag_path):
-                data = self.download_retry(flag_url)
+                try:
+                    data = self.download_retry(flag_url)
+                except RetriesExhausted:
+                    warn_nl("Skipping flag image {}.".format(flag_file))
+                    continue
                 with open(flag_path, "wb") as img_file:
                     img_file.write(data)
         url = "http://folkets-lexikon.csc.kth.se/folkets/folkets_%s_public.xml"
@@ -15,13 +15,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import re
+import sys
 import glob
 import shutil
 
 from pyquery import PyQuery as pq
+from lxml import etree
+from lxml.html import defs as html_defs
 
 from dictmaster.util import FLAGS
+from dictmaster.replacer import RegexPipeline
 from dictmaster.plugin import BasePlugin
 from dictmaster.stages.fetcher import ZipFetcher
 from dictmaster.stages.unzipper import Unzipper
@@ -592,33 +595,76 @@ class GcideUnzipper(Unzipper):
 
 class GcideProcessor(HtmlContainerProcessor):
     _last_container = None
+
+    pre_html_regex = RegexPipeline([
+        #[r"\x92", r"'"], # cp1252
+        [r"<!",r"<!--"],
+        [r"!>",r"-->"],
+        [r"<--",r"<!--"],
+        [r"(?i)<([a-z?][a-z0-9]*)/", r"<entity>\1</entity>"],
+        [r"(?i)\\'([0-9a-f]{2})", r"<unicode>\1</unicode>"],
+        [r"(?i)(\[?)<(/?)source>(\]?)", r"\3<\2source>\1"],
+        [r"(?i)( \})?<(/?)mhw>(\{ )?", r""],
+        [r"(?i)<(/?)(def|rj|note|cs|mcol|col|syn|ety|cref|cd|vmorph|amorph|plu|ecol|specif|wordforms|usage)>", r""],
+        [r"(?i)<(/?)(qex|sn|sd)>", r"<\1b>"],
+        [r"(?i)<(/?)(qau|au)>", r"<\1small>"],
+        [r"(?i)<(/?)(ex|xex|it|ptcl|contr|ant)>", r"<\1i>"],
+        # Sorting out yet unknown tags
+        #    [r"(?i)<(/?)()>", r"[\1\2]"],
+        [r"(?i)<as>(as( in the phrases)?,? ?)", r"\1<as>"],
+        [r"(?i)<ent>[^<]*</ent>", r""]
+    ])
+    strip_quotes = RegexPipeline([[r"[\"`\*']", ""]])
+
+    # tag: (family, action, new tag, color)
+    rewrite_tags = {
+        "entity": ("entity", "entity", None, None),
+        "unicode": ("unicode", "unicode", None, None),
+        "grk": ("grk", "grk", None, None),
+        "hw": ("hw", "strip", "b", "#00b"),
+        "wf": ("wf", "strip", "span", "#00b"),
+        "pr": ("pr", "strip", "i", None),
+        "q": ("q", "wrap", "i", "#33f"),
+        "pos": ("pos", "wrap", "i", "#a00"),
+        "pluf": ("pos", "wrap", "i", "#a00"),
+        **{t: ("mark", "wrap", "span", "#00b") for t in
+           ["mark", "fld", "conjf", "plw", "adjf", "altname", "sig", "usedfor"]},
+        "as": ("as", "wrap", "span", "33a"),
+        **{t: ("ets", "wrap", "span", "#8B4513") for t in ["ets", "spn", "gen", "stype"]},
+        "er": ("er", "link", "a", None),
+        # Including the sources unnecessarily blows up everything.
+        "source": ("source", "remove", None, None),
+    }
+
     def append(self, dt, dd):
         term = self.do_html_term(dt)
-        alts = self.do_html_alts(dd, term)
-        definition = self.do_html_definition(dd, term)
+        alts = self.do_html_alts(dt, dd, term)
+        definition = self.do_html_definition(dt, dd, term)
         if not term.strip():
             if self._last_container == None:
                  return
             term, olddef, oldalts = self._last_container
-            definition = olddef + self.do_html_definition(dd, term)
+            definition = olddef + self.do_html_definition(dt, dd, term)
             alts.extend(oldalts)
         elif self._last_container != None:
             Processor.append(self, *self._last_container)
         self._last_container = (term, definition, alts)
 
     def process(self):
+        # entries are only continued within a row, so that the result doesn't
+        # depend on which rows are processed by the same (worker) process
+        self._last_container = None
         HtmlContainerProcessor.process(self)
         if self._last_container != None:
             Processor.append(self, *self._last_container)
+        self._last_container = None
 
     def do_html_alts(self, dt_html, dd, term):
         d = pq(dd)
         alts = []
-        regex = [[r"[\"`\*']",""]]
         for hw in d.find("hw"):
             candidate = d(hw).text().strip().lower()
-            for r in regex:
-                candidate = re.sub(r[0],r[1],candidate)
+            candidate = self.strip_quotes.sub(candidate)
             candidate = candidate.strip()
             if candidate != term and candidate != "":
                 alts.append(candidate)
@@ -626,35 +672,12 @@ class GcideProcessor(HtmlContainerProcessor):
 
     def do_pre_html(self, encoded_str):
         data = encoded_str.decode("windows-1252")
-        regex = [
-            #[r"\x92", r"'"], # cp1252
-            [r"<!",r"<!--"],
-            [r"!>",r"-->"],
-            [r"<--",r"<!--"],
-            [r"(?i)<([a-z?][a-z0-9]*)/", r"<entity>\1</entity>"],
-            [r"(?i)\\'([0-9a-f]{2})", r"<unicode>\1</unicode>"],
-            [r"(?i)(\[?)<(/?)source>(\]?)", r"\3<\2source>\1"],
-            [r"(?i)( \})?<(/?)mhw>(\{ )?", r""],
-            [r"(?i)<(/?)(def|rj|note|cs|mcol|col|syn|ety|cref|cd|vmorph|amorph|plu|ecol|specif|wordforms|usage)>", r""],
-            [r"(?i)<(/?)(qex|sn|sd)>", r"<\1b>"],
-            [r"(?i)<(/?)(qau|au)>", r"<\1small>"],
-            [r"(?i)<(/?)(ex|xex|it|ptcl|contr|ant)>", r"<\1i>"],
-            # Sorting out yet unknown tags
-            #    [r"(?i)<(/?)()>", r"[\1\2]"],
-            [r"(?i)<as>(as( in the phrases)?,? ?)", r"\1<as>"],
-            [r"(?i)<ent>[^<]*</ent>", r""]
-        ]
-        for r in regex:
-            data = re.sub(r[0], r[1], data)
+        data = self.pre_html_regex.sub(data)
         return data.encode("windows-1252")
 
     def do_html_term(self, doc):
         term = doc("hw").eq(0).text().strip()
-        regex = [
-            [r"[\"`\*']",""]
-        ]
-        for r in regex:
-            term = re.sub(r[0], r[1], term)
+        term = self.strip_quotes.sub(term)
         return term.lower()
 
     def do_html_definition(self, dt_html, html, term):
@@ -666,137 +689,133 @@ class GcideProcessor(HtmlContainerProcessor):
             sys.exit()
 
         d = pq(html)
-        for e in html.find("entity"):
-            val = d(e).text()
-            replace = ""
-            if val in entities:
-                replace = entities[val]
-            d(e).replaceWith(replace)
-
-        for u in html.find("unicode"):
-            val = int(d(u).text(),16)
-            replace = chr(val)
-            d(u).replaceWith(replace)
-
-        for g in html.find("grk"):
-            val = greek_translit(d(g).text())
-            d(g).replaceWith(val)
-
-        for hw in html.find("hw"):
-            hw_html = re.sub(r"[\"`\*']","",d(hw).html())
-            d(hw).replaceWith(
-                d("<b/>").css("color", "#00b")
-                    .html(hw_html).outerHtml()
-            )
-
-        for wf in html.find("wf"):
-            wf_html = re.sub(r"[\"`\*']","",d(wf).html())
-            d(wf).replaceWith(
-                d("<span/>").css("color", "#00b")
-                    .html(wf_html).outerHtml()
-            )
-
-        for pr in html.find("pr"):
-            pr_html = re.sub(r"[\"`\*']","",d(pr).html())
-            d(pr).replaceWith(
-                d("<i/>").html(pr_html).outerHtml()
-            )
-
-        for q in html.find("q"):
-            d(q).replaceWith(
-                d("<i/>").css("color", "#33f")
-                    .html(d(q).html()).outerHtml()
-            )
-
-        for pos in html.find("pos,pluf"):
-            d(pos).replaceWith(
-                d("<i/>").css("color", "#a00")
-                    .html(d(pos).html()).outerHtml()
-            )
-
-        for m in html.find("mark,fld,conjf,plw,adjf,altname,sig,usedfor"):
-            d(m).replaceWith(
-                d("<span/>").css("color", "#00b")
-                    .html(d(m).html()).outerHtml()
-            )
-
-        for a in html.find("as"):
-            d(a).replaceWith(
-                d("<span/>").css("color", "33a")
-                    .html(d(a).html()).outerHtml()
-            )
-
-        for ets in html.find("ets,spn,gen,stype"):
-            d(ets).replaceWith(
-                d("<span/>").css("color", "#8B4513")
-                    .html(d(ets).html()).outerHtml()
-            )
-
-        for er in html.find("er"):
-            href = d(er).text().strip()
-            if href == "":
-                d(er).replaceWith("")
+        # Children are rewritten before their parents, so that the text of an
+        # element is final when it's read. This is done in place, but gives the
+        # same result as rewriting one family of tags after the other (in the
+        # order of `rewrite_tags`) with a round-trip through the serializer:
+        # - Matches nested in a match of the same family are left alone.
+        # - Removals come last, since the removed text may end up in a link.
+        removed = []
+        walk = etree.iterwalk(html[0], events=("end",), tag=list(self.rewrite_tags))
+        for _, el in list(walk):
+            family, action, tag, color = self.rewrite_tags[el.tag]
+            ancestors = [self.rewrite_tags.get(a.tag, (None, None)) for a in el.iterancestors()]
+            if any(a[0] == family for a in ancestors):
+                continue
+            if action == "remove":
+                removed.append(el)
+                continue
+            if action in ("entity", "unicode", "grk"):
+                text = d(el).text()
+                if action == "entity":
+                    text = entities.get(text, "")
+                elif action == "unicode":
+                    text = chr(int(text, 16))
+                else:
+                    text = greek_translit(text)
+                self._replace_text(d, el, text)
+                continue
+            if action == "link":
+                if any(a[1] == "strip" for a in ancestors):
+                    self._strip_quotes(el)
+                href = d(el).text().strip()
+                if href == "":
+                    self._replace_text(d, el, "")
+                    continue
+                # Word groups are not indexed, hence it makes sense to link
+                # to the first part of a compound only.
+                attrib = {"href": self._html_href("bword://%s" % href.split(" ")[0])}
             else:
-                """
-                Word groups are not indexed, hence it makes sense to link to the
-                first part of a compound only.
-                """
-                href = href.split(" ")[0]
-                d(er).replaceWith(
-                    d("<a/>").attr("href", "bword://%s" % href)
-                        .html(d(er).html()).outerHtml()
-                )
-
-        for src in html.find("source"):
-            """
-            replacement = d("<p/>").css("text-align","right")
-                .css("font-size","x-small")
-                .html(d(src).html()).outerHtml()
-            """
-            "Including the sources unnecessarily blows up everything."
-            replacement = ""
-            d(src).replaceWith(replacement)
+                if action == "strip":
+                    self._strip_quotes(el)
+                attrib = {} if color is None else {"style": "color: %s" % color}
+            self._retag(el, tag, attrib)
+        for el in removed:
+            self._replace_text(d, el, "")
+        for el in html[0].iter(etree.Element):
+            # empty elements are serialized as `<b/>` otherwise
+            if el.text is None and len(el) == 0 and el.tag not in html_defs.empty_tags:
+                el.text = ""
 
         output = "<p>%s</p>" % html.html().strip()
         return output
 
-def gcide_grk_to_utf8(grk_str):
-    found_len = 0
-    found_xlit = None
-
-    if grk_str == "s":
+    def _strip_quotes(self, el):
+        """ Same as applying `strip_quotes` to the inner HTML of `el` """
+        for node in el.iter():
+            if node.text:
+                node.text = self.strip_quotes.sub(node.text)
+            if node is not el and node.tail:
+                node.tail = self.strip_quotes.sub(node.tail)
+
+    @staticmethod
+    def _html_href(href):
+        """ `href` after a round-trip through the HTML serializer, which escapes it """
+        a = etree.tostring(etree.Element("a", href=href), method="html")
+        return etree.fromstring(a, etree.HTMLParser()).find(".//a").get("href")
+
+    @staticmethod
+    def _retag(el, tag, attrib):
+        el.tag = tag
+        el.attrib.clear()
+        el.attrib.update(attrib)
+
+    @staticmethod
+    def _replace_text(d, el, text):
+        parent, prev = el.getparent(), el.getprevious()
+        if "<" in text or "&" in text:
+            # let the HTML parser deal with it
+            d(el).replaceWith(text)
+        else:
+            # like pyquery's replaceWith, this leaves an empty (not a missing)
+            # text in the parent
+            text += el.tail or ""
+            if prev is not None:
+                prev.tail = (prev.tail or "") + text
+            else:
+                parent.text = (parent.text or "") + text
+            parent.remove(el)
+
+def _xlit_trie(xlit):
+    trie = {}
+    for latin, greek in xlit:
+        node = trie
+        for c in latin:
+            node = node.setdefault(c, {})
+        # the first of several equal transliterations wins
+        node.setdefault(None, greek)
+    return trie
+
+xlit_trie = _xlit_trie(xlit)
+
+def _grk_match(grk_str, start):
+    """ Longest transliteration at position `start` of `grk_str` """
+    if start == len(grk_str) - 1 and grk_str[start] == "s":
         return (1, "ς")
 
-    for p in xlit:
-        i = 0
-        while i < min(len(grk_str),len(p[0])) and p[0][i] == grk_str[i]:
-            i += 1
-
-        if i < len(p[0]):
-            if found_len > 0 and i == 0:
-                break
-            continue
-
-        if i > found_len:
-            found_len = i
-            found_xlit = p
-
-    if found_len:
-        return (found_len, found_xlit[1])
-    return (None, None)
+    found_len, found_xlit = None, None
+    node = xlit_trie
+    for i in range(start, len(grk_str)):
+        node = node.get(grk_str[i])
+        if node is None:
+            break
+        if None in node:
+            found_len, found_xlit = i + 1 - start, node[None]
+    return (found_len, found_xlit)
 
+def gcide_grk_to_utf8(grk_str):
+    return _grk_match(grk_str, 0)
 
 def greek_translit(grk_str):
-    result = ""
+    result = []
     n = 0
     while len(grk_str) > n:
-        gr_len, greek = gcide_grk_to_utf8(grk_str[n:])
+        gr_len, greek = _grk_match(grk_str, n)
 
         if greek:
-            result += greek
+            result.append(greek)
             n += gr_len
         else:
-            result += grk_str[n]
+            result.append(grk_str[n])
             n += 1
-    return result
-
+    return "".join(result)
@@ -77,7 +77,7 @@ class OxfordProcessor(HtmlAXProcessor):
         for r in regex: term = re.sub(r[0], r[1], term)
         return term
 
-    def do_html_definition(self, doc, term):
+    def do_html_definition(self, dt, doc, term):
         doc("script").remove()
         doc("div.examples").remove()
         doc("div.synonyms").remove()
@@ -21,7 +21,7 @@ import os
 from pyquery import PyQuery as pq
 from lxml import etree
 
-from dictmaster.util import FLAGS
+from dictmaster.util import FLAGS, RetryPolicy, RetriesExhausted, warn_nl
 from dictmaster.replacer import *
 from dictmaster.plugin import BasePlugin
 from dictmaster.stages.fetcher import Fetcher
@@ -85,8 +85,7 @@ class Plugin(BasePlugin):
 
 class ZenoUrlFetcher(UrlFetcher):
     class FetcherThread(UrlFetcher.FetcherThread):
-        _retry403 = True
-        _retry404 = True
+        retry_policy = RetryPolicy(rules={403: "retry", 404: "retry"})
 
         def filter_data(self, data, uri):
             d = pq(data)
@@ -103,8 +102,7 @@ class ZenoUrlFetcher(UrlFetcher):
 
 class ZenoFetcher(Fetcher):
     class FetcherThread(Fetcher.FetcherThread):
-        _retry403 = True
-        _retry404 = True
+        retry_policy = RetryPolicy(rules={403: "retry", 404: "retry"})
 
         def parse_uri(self, uri):
             return ZENO_URL + uri
@@ -135,6 +133,12 @@ class ZenoFetcher(Fetcher):
         self._queue.reload_duplicates = True
 
 class ZenoProcessor(HtmlContainerProcessor):
+    term_regex = RegexPipeline([
+        [";", ""],
+        [r"\s*\[\*\]\s*$", ""],
+        [r"\s*\[([0-9]+)\]\s*$", r"(\1)"],
+    ])
+
     nonarticles = []
     def do_html_term(self, html):
         doc = pq(html)
@@ -150,10 +154,7 @@ class ZenoProcessor(HtmlContainerProcessor):
             else:
                 print(html)
                 sys.exit()
-        term = re.sub(r"\s*\[([0-9]+)\]\s*$", r"(\1)",
-            re.sub(r"\s*\[\*\]\s*$", "", term.replace(";",""))
-        )
-        return term
+        return self.term_regex.sub(term)
 
     def do_html_definition(self, dt_html, html, term):
         if term == "":
@@ -219,7 +220,11 @@ class ZenoProcessor(HtmlContainerProcessor):
         for img in doc.find("img"):
             url = "%s%s" % (ZENO_URL, doc(img).attr("src"))
             basename = url.split('/')[-1]
-            data = self.download_retry(url)
+            try:
+                data = self.download_retry(url)
+            except RetriesExhausted:
+                warn_nl("Skipping image {}.".format(url))
+                continue
             res_dirname = os.path.join(self.plugin.output_directory, "res")
             basename = basename.split("?")[0]
             with open(os.path.join(res_dirname, basename), "wb") as img_file:
@@ -17,32 +17,64 @@
 
 import queue
 import sqlite3
+import time
 
-from dictmaster.util import CancelableThread, FLAGS
+from dictmaster.util import CancelableThread, FLAGS, data_hash
+
+# passed instead of the data of a page that didn't change since it was stored
+UNCHANGED = object()
 
 class QueueThread(CancelableThread):
     _queue = None
 
-    def __init__(self):
+    batch_size = 1
+    batch_timeout = 0
+
+    def __init__(self, batch_size=1, batch_timeout=0):
         super().__init__()
         self._queue = queue.Queue()
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
 
     def process_item(self, item): return None
     def put(self, item): self._queue.put(item)
+    def qsize(self): return self._queue.qsize()
+
+    def process_batch(self, items):
+        for item in items:
+            self.process_item(item)
 
     def progress(self):
         return "Digesting queue... {}.".format(self._queue.qsize())
 
+    def get_batch(self):
+        """ Wait for up to `batch_size` items or `batch_timeout` milliseconds """
+        try: items = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_timeout / 1000.0
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    items.append(self._queue.get(timeout=remaining))
+                else:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
     def run(self):
         while True:
-            try: item = self._queue.get(timeout=1)
-            except queue.Empty:
+            items = self.get_batch()
+            if len(items) == 0:
                 if self._canceled:
                      break
                 else:
                      continue
-            self.process_item(item)
-            self._queue.task_done()
+            self.process_batch(items)
+            for _ in items:
+                self._queue.task_done()
 
 class RawDbQueue(QueueThread):
     output_db = ""
@@ -50,49 +82,123 @@ class RawDbQueue(QueueThread):
 
     _conn = None
     _c = None
+    _written = 0
+    _t_start = None
 
-    def __init__(self, db_file):
-        super().__init__()
+    def __init__(self, db_file, batch_size=500, batch_timeout=2000):
+        super().__init__(batch_size=batch_size, batch_timeout=batch_timeout)
         self.output_db = db_file
 
-    def process_item(self, item):
-        rawid, uri, data, flag = item
+    def process_batch(self, items):
+        """ Write a batch of fetched items to the raw table in one transaction
+
+        Items are written via `executemany`, hence duplicates within the same
+        batch have to be detected before anything is sent to the database.
+        Pages that were fetched again without changes (or that are UNCHANGED
+        according to the HTTP cache) only get their flag updated.
+        """
+        inserts, updates, reloads, unchanged = [], [], [], []
+        pending = {}
+        # data of duplicates that were reloaded in this batch, the next page
+        # with the same data is stored like the first one
+        cleared = set()
+        stored = self.stored_hashes(items)
         test_flag = FLAGS["RAW_FETCHER"] | FLAGS["FETCHED"]
-        if flag & test_flag == test_flag:
-            self._c.execute('''
-                SELECT id, uri, flag FROM raw WHERE data=?
-            ''', (data,))
-            dupdata = self._c.fetchone()
-            if dupdata != None:
-                dupid, dupuri, dupflag = dupdata
-                if self.reload_duplicates:
-                    self._c.execute('''
-                        UPDATE raw SET flag=?, data=? WHERE id=?
-                    ''', (dupflag ^ FLAGS["FETCHED"], None, dupid))
-                    return
+        for rawid, uri, data, flag in items:
+            if data is UNCHANGED:
+                unchanged.append((flag, rawid))
+                continue
+            if rawid in stored and stored[rawid] == data_hash(data):
+                unchanged.append((flag, rawid))
+                continue
+            if flag & test_flag == test_flag:
+                dupdata = None
+                if data in pending:
+                    dupidx = pending[data]
+                    dupid, dupuri, _, dupflag = updates[dupidx]
+                    dupdata = (dupid, dupuri, dupflag)
+                elif data in cleared:
+                    dupidx = None
                 else:
-                    flag |= FLAGS["DUPLICATE"]
-                    data = dupid
-        if rawid == None:
-            self._c.execute('''
-                INSERT INTO raw(uri,data,flag)
-                VALUES (?,?,?)
-            ''', (uri, data, flag))
-        else:
+                    self._c.execute('''
+                        SELECT id, uri, flag FROM raw
+                        WHERE data_hash=? AND data=?
+                    ''', (data_hash(data), data))
+                    dupdata = self._c.fetchone()
+                    dupidx = None
+                if dupdata != None:
+                    dupid, dupuri, dupflag = dupdata
+                    if self.reload_duplicates:
+                        cleared.add(data)
+                        if dupidx is None:
+                            reloads.append((dupflag ^ FLAGS["FETCHED"], None, dupid))
+                        else:
+                            updates[dupidx] = (dupid, dupuri, None, dupflag ^ FLAGS["FETCHED"])
+                            del pending[data]
+                        continue
+                    else:
+                        flag |= FLAGS["DUPLICATE"]
+                        data = dupid
+            if rawid == None:
+                inserts.append((uri, data, flag))
+            else:
+                if data is not None and data not in pending:
+                    pending[data] = len(updates)
+                updates.append((rawid, uri, data, flag))
+        self._c.executemany('''
+            UPDATE raw
+            SET uri=?, data=?, data_hash=?, flag=?
+            WHERE id=?
+        ''', [
+            (uri, data, data_hash(data), flag, rawid)
+            for rawid, uri, data, flag in updates
+        ])
+        self._c.executemany('''
+            UPDATE raw SET flag=?, data=?, data_hash=NULL WHERE id=?
+        ''', reloads)
+        self._c.executemany('''
+            UPDATE raw SET flag=? WHERE id=?
+        ''', unchanged)
+        self._c.executemany('''
+            INSERT INTO raw(uri,data,data_hash,flag)
+            VALUES (?,?,?,?)
+        ''', [(uri, data, data_hash(data), flag) for uri, data, flag in inserts])
+        self._conn.commit()
+        self._written += len(inserts) + len(updates) + len(reloads) + len(unchanged)
+
+    def stored_hashes(self, items):
+        """ Data hashes of the rows that are about to be overwritten by `items` """
+        rawids = [item[0] for item in items if item[0] is not None
+                  and item[2] is not None and item[2] is not UNCHANGED]
+        stored = {}
+        for i in range(0, len(rawids), 500):
+            chunk = rawids[i:i+500]
             self._c.execute('''
-                UPDATE raw
-                SET uri=?, data=?, flag=?
-                WHERE id=?
-            ''', (uri, data, flag, rawid))
+                SELECT id, data_hash FROM raw
+                WHERE id IN ({}) AND data_hash IS NOT NULL
+            '''.format(",".join("?" * len(chunk))), chunk)
+            stored.update(self._c.fetchall())
+        return stored
+
+    def process_item(self, item):
+        self.process_batch([item])
+
+    def rate(self):
+        if self._t_start is None:
+            return 0.0
+        elapsed = time.monotonic() - self._t_start
+        return self._written / elapsed if elapsed > 0 else 0.0
 
     def progress(self):
-        return "Writing to db... {}.".format(self._queue.qsize())
+        return "Writing to db... {} ({:.1f} rows/s).".format(
+            self._queue.qsize(), self.rate()
+        )
 
     def run(self):
         self._conn = sqlite3.connect(self.output_db)
         self._conn.text_factory = str
         self._c = self._conn.cursor()
+        self._t_start = time.monotonic()
         QueueThread.run(self)
         self._conn.commit()
         self._conn.close()
-
@@ -16,18 +16,85 @@
 
 import re
 
+from pyquery import PyQuery
+
+_REGEX_META = set(".^$*+?{}[]\\|()")
+
+class RegexPipeline(object):
+    """
+    A list of (pattern, repl) substitutions that are applied one after the
+    other, just like a loop over `re.sub`, but compiled only once. Literal
+    substitutions are done with `str.replace`.
+    """
+    rules = []
+
+    _steps = None
+
+    def __init__(self, rules):
+        self.rules = [tuple(r) for r in rules]
+        self._steps = []
+        for pattern, repl in self.rules:
+            if self._is_literal(pattern, repl):
+                self._steps.append(self._replace_step(pattern, repl))
+            else:
+                self._steps.append(self._regex_step(pattern, repl))
+
+    @staticmethod
+    def _is_literal(pattern, repl):
+        if not isinstance(pattern, str) or not isinstance(repl, str):
+            return False
+        return len(pattern) > 0 and not any(c in _REGEX_META for c in pattern) \
+            and "\\" not in repl
+
+    @staticmethod
+    def _replace_step(pattern, repl):
+        return lambda s: s.replace(pattern, repl)
+
+    @staticmethod
+    def _regex_step(pattern, repl):
+        regex = re.compile(pattern)
+        return lambda s: regex.sub(repl, s)
+
+    def sub(self, string):
+        for step in self._steps:
+            string = step(string)
+        return string
+
 def doc_replace_els(doc, query, fun):
-    old_html = ""
-    new_html = doc.html()
-    while old_html != new_html:
-        old_html = new_html
-        el = doc(query).eq(0)
-        doc(el).replaceWith(fun(el))
-        new_html = doc.html()
+    """
+    Replace each element matching `query` by `fun(el)`.
+
+    Matches are replaced in document order. Matches inside a replaced element
+    are skipped, since the replacement is built from (and contains copies of)
+    them: they are handled in the next pass, just like any new matches that
+    the replacements introduce. Passes are repeated until one of them doesn't
+    change anything.
+    """
+    if len(doc) == 0:
+        return
+    root = doc.root.getroot()
+    changed = True
+    while changed:
+        changed = False
+        for el in doc(query):
+            if el.getroottree().getroot() is not root:
+                continue
+            el = doc(el)
+            old_html = el.outerHtml()
+            replacement = fun(el)
+            if isinstance(replacement, PyQuery):
+                new_html = replacement.outerHtml()
+            else:
+                new_html = str(replacement)
+            if new_html != old_html:
+                el.replaceWith(replacement)
+                changed = True
 
 def doc_rewrap_els(doc, query, new_el, css=[], remove_empty=True,
                    textify=False, prefix="", suffix="", regex=[],
                    transfer_attr=[]):
+    if not isinstance(regex, RegexPipeline):
+        regex = RegexPipeline(regex)
     def fun(el):
         if textify:
             replacement = doc(el).text()
@@ -36,8 +103,7 @@ def doc_rewrap_els(doc, query, new_el, css=[], remove_empty=True,
         if replacement is None:
             replacement = ""
         if replacement != "" or not remove_empty:
-            for r in regex:
-                replacement = re.sub(r[0], r[1], replacement)
+            replacement = regex.sub(replacement)
             replacement = doc(new_el).html(prefix + replacement + suffix)
             for s in css: replacement.css(*s)
             for a in transfer_attr:
@@ -17,6 +17,7 @@
 import os
 import random
 import sqlite3
+import threading
 import time
 
 try:
@@ -24,11 +25,208 @@ try:
 except ImportError:
     import urllib.request as urllib2
 
-from dictmaster.util import mkdir_p, CancelableThread, FLAGS
-from dictmaster.queue import RawDbQueue
+from dictmaster.util import mkdir_p, warn_nl, format_bytes, CancelableThread, \
+                            ConnectionPool, RetriesExhausted, NotModified, FLAGS, data_hash
+from dictmaster.queue import RawDbQueue, UNCHANGED
+from dictmaster.aio import AsyncFetchEngine, AsyncHttpClient, DEFAULT_CONCURRENCY
 
 DEFAULT_THREADCNT=6
 
+class ConcurrencyController(object):
+    """
+    Limits the number of fetch workers that are active at the same time and
+    adapts the limit during the run (AIMD): the limit grows by one after each
+    window of healthy requests and is cut in half if the remote host throttles
+    (429/503) or times out, if latencies rise, or if the database writer
+    falls behind.
+    """
+    window = 20
+    max_error_rate = 0.05
+    max_latency_factor = 2.0
+    max_backlog = 1000
+    backoff = 0.5
+
+    limit = 1
+    min_limit = 1
+    max_limit = 1
+    active = 0
+
+    _cond = None
+    _latencies = None
+    _errors = 0
+    _base_latency = None
+    _queue = None
+
+    def __init__(self, limit, max_limit, min_limit=1, queue=None):
+        self.limit = float(limit)
+        self.min_limit, self.max_limit = min_limit, max_limit
+        self._cond = threading.Condition()
+        self._latencies = []
+        self._queue = queue
+
+    def try_acquire(self):
+        with self._cond:
+            if self.active >= int(self.limit):
+                return False
+            self.active += 1
+            return True
+
+    def acquire(self, fthread):
+        """ Block until a slot is free, return False if `fthread` is canceled """
+        with self._cond:
+            while self.active >= int(self.limit):
+                if fthread._canceled:
+                    return False
+                self._cond.wait(1)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def slot(self):
+        return WorkerSlot(self)
+
+    def record(self, latency, status):
+        with self._cond:
+            if status in (429, 503, "timeout"):
+                self._errors += 1
+            else:
+                self._latencies.append(latency)
+            if len(self._latencies) + self._errors >= self.window:
+                self._adjust()
+                self._cond.notify_all()
+
+    def _adjust(self):
+        n_samples = len(self._latencies) + self._errors
+        error_rate = self._errors / n_samples
+        latencies = sorted(self._latencies)
+        p90 = latencies[int(0.9 * (len(latencies) - 1))] if latencies else None
+        if p90 is not None:
+            # the baseline slowly follows the observed latency
+            if self._base_latency is None:
+                self._base_latency = p90
+            self._base_latency = min(p90, 1.05 * self._base_latency)
+        slow = p90 is not None and p90 > self.max_latency_factor * self._base_latency
+        backlog = self._queue is not None and self._queue.qsize() > self.max_backlog
+        if error_rate > self.max_error_rate or slow or backlog:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._latencies, self._errors = [], 0
+
+    def progress(self):
+        return "workers: {} of {}".format(int(self.limit), self.max_limit)
+
+class WorkerSlot(object):
+    """
+    The slot of one fetch worker in a ConcurrencyController. It is given up
+    while a download waits for a retry, so that the limit only counts the
+    workers that actually send requests.
+    """
+    held = False
+
+    _controller = None
+
+    def __init__(self, controller):
+        self._controller = controller
+
+    def acquire(self, fthread):
+        """ Block until a slot is free, return False if `fthread` is canceled """
+        self.held = self._controller.acquire(fthread)
+        return self.held
+
+    def try_acquire(self):
+        self.held = self._controller.try_acquire()
+        return self.held
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self._controller.release()
+
+class RetryTable(object):
+    """
+    Downloads that were postponed by the retry policy, together with the
+    number of rounds they have been postponed and the time they are due again.
+    Downloads that exceed the policy's `max_rounds` are given up for this run.
+    """
+    _policy = None
+    _sleep = (1.0, 3.0)
+    _entries = None
+    _lock = None
+
+    def __init__(self, policy, sleep):
+        self._policy, self._sleep = policy, sleep
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def add(self, rawid, uri, retry_after=None):
+        with self._lock:
+            rounds = self._entries.get(rawid, (0, None))[0] + 1
+            due = None
+            if rounds < self._policy.max_rounds:
+                delay = self._policy.round_delay(rounds, self._sleep, retry_after)
+                due = time.monotonic() + delay
+            self._entries[rawid] = (rounds, due)
+        if due is None:
+            warn_nl(f"Giving up on {uri} after {rounds} rounds.")
+
+    def split(self, uris):
+        """ Return the uris that are due and the seconds until the next one is """
+        now = time.monotonic()
+        due_uris, wait = [], None
+        with self._lock:
+            for rawid, uri in uris:
+                rounds, due = self._entries.get(rawid, (0, now))
+                if due is None:
+                    continue
+                elif due <= now:
+                    due_uris.append((rawid, uri))
+                else:
+                    wait = due - now if wait is None else min(wait, due - now)
+        return due_uris, wait
+
+class StoredDigests(object):
+    """
+    Digests of the data that the rows in `uris` hold from an earlier run.
+    They are looked up in batches of `batch_size` rows, in the order of
+    `uris`, so only one batch of them is kept in memory at a time.
+    """
+    batch_size = 500
+
+    _output_db = ""
+    _rawids = None
+    _next = 0
+    _batch = None
+    _digests = None
+    _lock = None
+
+    def __init__(self, output_db, uris):
+        self._output_db = output_db
+        self._rawids = [rawid for rawid, uri in uris]
+        self._batch, self._digests = set(), {}
+        self._lock = threading.Lock()
+
+    def get(self, rawid):
+        with self._lock:
+            while rawid not in self._batch and self._next < len(self._rawids):
+                self._load_batch()
+            return self._digests.get(rawid)
+
+    def _load_batch(self):
+        batch = self._rawids[self._next:self._next + self.batch_size]
+        self._next += len(batch)
+        conn = sqlite3.connect(self._output_db)
+        self._digests = dict(conn.execute('''
+            SELECT id, data_hash FROM raw
+            WHERE id IN ({}) AND data_hash IS NOT NULL
+        '''.format(",".join("?" * len(batch))), batch).fetchall())
+        conn.close()
+        self._batch = set(batch)
+
 class FetcherThread(CancelableThread):
     uris = []
     postdata = None
@@ -37,25 +235,62 @@ class FetcherThread(CancelableThread):
     _i = 0
     _flag = 0
     _queue = None
+    _retries = None
+    _stored = None
+    _slot = None
 
     def __init__(self, no, uris, queue, flag, postdata=None,
-                 pause=None, **kwargs):
+                 pause=None, retries=None, stored=None, **kwargs):
         super().__init__(**kwargs)
         self.uris, self.postdata = uris, postdata
         self.no = no
         self.pause = pause
         self._queue = queue
+        self._retries = retries
+        self._stored = stored or {}
         self._flag = flag | FLAGS["FETCHED"]
         self._canceled = len(self.uris) == 0
 
     def filter_data(self, data, uri): return data
     def parse_uri(self, uri): return uri
 
+    def stored(self, rawid):
+        """
+        Digest of the data stored for `rawid` by an earlier run (or None).
+        Expected to be called in the order of `uris`.
+        """
+        return self._stored.get(rawid)
+
     def fetch_uri(self, rawid, uri):
-        data = self.download_retry(self.parse_uri(uri), self.postdata)
-        if self._canceled:
-             return
-        data = self.filter_data(data, uri)
+        try:
+            data = self.download_retry(self.parse_uri(uri), self.postdata,
+                                       stored=self.stored(rawid), slot=self._slot)
+            if self._canceled:
+                 return
+            self.store(rawid, uri, data)
+        except NotModified:
+            self.keep(rawid, uri)
+        except RetriesExhausted as e:
+            self.defer(rawid, uri, e.retry_after)
+
+    def keep(self, rawid, uri):
+        """ Leave the data stored for `uri` as it is, the page didn't change """
+        self._queue.put((rawid, uri, UNCHANGED, self._flag))
+        self._i += 1
+
+    def defer(self, rawid, uri, retry_after=None):
+        """ Leave `uri` unfetched and retry it in one of the next rounds """
+        if self._retries is not None:
+            self._retries.add(rawid, uri, retry_after)
+        self._i += 1
+
+    def store(self, rawid, uri, data):
+        self.store_filtered(rawid, uri, self.filter_data(data, uri))
+
+    def store_filtered(self, rawid, uri, data):
+        """ Pass the data of `uri` to the queue, after filter_data """
+        if self.cache is not None and self.postdata is None:
+            self.cache.set_digest(self.parse_uri(uri), data_hash(data))
         self._queue.put((rawid, uri, data, self._flag))
         self._i += 1
 
@@ -63,7 +298,14 @@ class FetcherThread(CancelableThread):
         for rawid, uri in self.uris:
             if self._canceled:
                 break
-            self.fetch_uri(rawid, uri)
+            if self.controller is None:
+                self.fetch_uri(rawid, uri)
+            else:
+                self._slot = self.controller.slot()
+                if self._slot.acquire(self):
+                    try: self.fetch_uri(rawid, uri)
+                    finally: self._slot.release()
+                self._slot = None
             if self.pause is not None:
                 sleep_time = random.uniform(*self.pause)
                 while sleep_time > 0:
@@ -84,8 +326,18 @@ class Fetcher(CancelableThread):
 
     plugin = None
     postdata = None
+    threadcnt = DEFAULT_THREADCNT
+    engine = "threads"
+    concurrency = DEFAULT_CONCURRENCY
+    pool_size = None
+    adaptive = False
+    max_threadcnt = None
 
     _subthreads = []
+    _pool = None
+    _controller = None
+    _retries = None
+    _resume_at = None
     _flag = FLAGS["RAW_FETCHER"]
     _queue = None
     _fetched = 0
@@ -95,22 +347,67 @@ class Fetcher(CancelableThread):
         threadcnt=DEFAULT_THREADCNT,
         postdata=None,
         pause=None,
+        engine="threads",
+        concurrency=DEFAULT_CONCURRENCY,
+        pool_size=None,
+        adaptive=False,
+        max_threadcnt=None,
         **kwargs
     ):
         super().__init__(**kwargs)
+        if "retry_policy" not in kwargs:
+            self.retry_policy = self.FetcherThread.retry_policy
+        self.threadcnt = threadcnt
         self._subthreads = [None] * threadcnt
         self.pause = pause
         self.plugin = plugin
         self.postdata = postdata
+        self.engine = engine
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.adaptive = adaptive
+        self.max_threadcnt = max_threadcnt
 
     def init_queue(self):
         self._queue = RawDbQueue(self.plugin.output_db)
 
+    def init_controller(self):
+        self._controller = None
+        if not self.adaptive:
+            return
+        if self.engine == "async":
+            max_limit = self.concurrency
+            limit = max(1, self.concurrency // 4)
+        else:
+            max_limit = self.max_threadcnt or 4 * self.threadcnt
+            limit = self.threadcnt
+        self._controller = ConcurrencyController(
+            min(limit, max_limit), max_limit, queue=self._queue
+        )
+
     def init_subthreads(self, uris):
         self.init_queue()
+        self.init_controller()
+        if self.engine == "async":
+            # a single (never started) thread hosts the plugin hooks
+            self._subthreads = [None]
+            pool_size = self.concurrency if self.pool_size is None else self.pool_size
+            if self._pool is None:
+                self._pool = AsyncHttpClient(pool_size=pool_size)
+        else:
+            threadcnt = self.threadcnt
+            if self._controller is not None:
+                threadcnt = self._controller.max_limit
+            self._subthreads = [None] * threadcnt
+            pool_size = threadcnt if self.pool_size is None else self.pool_size
+            if self._pool is None:
+                self._pool = ConnectionPool(size=pool_size)
         self._subthreads = self._subthreads[:len(uris)]
         for i in range(len(self._subthreads)):
             uri_portion = uris[i::len(self._subthreads)]
+            stored = None
+            if self.plugin.http_cache is not None:
+                stored = StoredDigests(self.plugin.output_db, uri_portion)
             self._subthreads[i] = self.FetcherThread(
                 no=i,
                 uris=uri_portion,
@@ -118,10 +415,21 @@ class Fetcher(CancelableThread):
                 flag=self._flag,
                 postdata=self.postdata,
                 pause=self.pause,
-                sleep=self.sleep
+                sleep=self.sleep,
+                retry_policy=self.retry_policy,
+                retries=self._retries,
+                stored=stored,
+                pool=self._pool if self.engine == "threads" else self._pool.fallback,
+                limiter=self.plugin.rate_limiter,
+                cache=self.plugin.http_cache,
+                controller=self._controller
             )
 
     def progress(self):
+        if self._resume_at is not None:
+            return "Retrying postponed downloads in {:.0f} sec...".format(
+                self._resume_at - time.monotonic()
+            )
         if None in self._subthreads:
              return "Initializing threads..."
         if self._canceled:
@@ -132,6 +440,16 @@ class Fetcher(CancelableThread):
             percentage = 100 * self._fetched
             percentage += (1 - self._fetched) * float(sum(sub_p)) / len(sub_p)
             prog += "{:.2f}%".format(percentage)
+            if self._pool.requests > 0:
+                prog += " (reused connections: {} of {})".format(
+                    self._pool.reused, self._pool.requests
+                )
+            if self._pool.received > 0:
+                prog += " ({})".format(self.transfer_stats())
+            if self._controller is not None:
+                prog += " ({})".format(self._controller.progress())
+            if self.plugin.http_cache is not None:
+                prog += " ({})".format(self.plugin.http_cache.progress())
         elif any(type(p) == str and p[:11] == "Downloading" for p in sub_p):
             for p in sub_p:
                 if type(p) == str and p[:11] == "Downloading":
@@ -157,21 +475,41 @@ class Fetcher(CancelableThread):
         conn.close()
         return n_fetched, uris
 
+    def wait_until(self, resume_at):
+        self._resume_at = resume_at
+        while not self._canceled and time.monotonic() < resume_at:
+            time.sleep(min(resume_at - time.monotonic(), 1))
+        self._resume_at = None
+
+    def transfer_stats(self):
+        return "received {} for {} of data".format(
+            format_bytes(self._pool.received), format_bytes(self._pool.decoded)
+        )
+
     def run(self):
-        self._fetched, uris = self.get_unfetched_uris()
-        self._fetched = float(self._fetched) / (len(uris) + self._fetched)
-        if self._canceled or len(uris) == 0:
-             return
-        self.init_subthreads(uris)
-        self._queue.start()
-        [s.start() for s in self._subthreads]
-        [s.join() for s in self._subthreads]
-        self._queue.cancel()
-        self._queue.join()
-        if self._canceled:
-             return
-        # restart in case some uris couldn't be fetched due to problems
-        self.run()
+        self._pool = None
+        self._retries = RetryTable(self.retry_policy, self.sleep)
+        # repeat in case some uris couldn't be fetched due to problems
+        while not self._canceled:
+            n_fetched, uris = self.get_unfetched_uris()
+            uris, wait = self._retries.split(uris)
+            if len(uris) == 0:
+                if wait is None:
+                    break
+                self.wait_until(time.monotonic() + wait)
+                continue
+            self._fetched = float(n_fetched) / (len(uris) + n_fetched)
+            self.init_subthreads(uris)
+            self._queue.start()
+            if self.engine == "async":
+                AsyncFetchEngine(self._subthreads[0], self.concurrency, self._pool).run()
+            else:
+                [s.start() for s in self._subthreads]
+                [s.join() for s in self._subthreads]
+            self._queue.cancel()
+            self._queue.join()
+        if self._pool is not None and self._pool.received > 0:
+            warn_nl("Fetcher {}.".format(self.transfer_stats()))
 
     def reset(self):
         conn = sqlite3.connect(self.plugin.output_db)
@@ -191,19 +529,30 @@ class Fetcher(CancelableThread):
 class ZipFetcher(Fetcher):
     class FetcherThread(FetcherThread):
         def fetch_uri(self, rawid, uri):
-            data = self.download_retry(self.parse_uri(uri), self.postdata)
-            if self._canceled:
-                 return
-            path = self.to_file(data)
-            self._queue.put((rawid, uri, path, self._flag))
+            try:
+                path = self.download_retry(
+                    self.parse_uri(uri), self.postdata, dest=self.to_file(),
+                    slot=self._slot
+                )
+                if self._canceled:
+                     return
+                self.store(rawid, uri, path)
+            except RetriesExhausted as e:
+                self.defer(rawid, uri, e.retry_after)
+
+        def store(self, rawid, uri, path):
+            self._queue.put((rawid, uri, path or None, self._flag))
             self._i += 1
 
     def __init__(self, plugin, postdata=None):
         super().__init__(plugin,threadcnt=1,postdata=postdata)
         self._flag = FLAGS["ZIP_FETCHER"]
-        def to_file(fthread, data):
+        def to_file(fthread):
             zdirname = os.path.join(self.plugin.output_directory, "zip")
-            path = os.path.join(zdirname, "{}_{}".format(fthread.no, fthread._i))
-            with open(path, "wb") as f: f.write(data)
-            return path
+            return os.path.join(zdirname, "{}_{}".format(fthread.no, fthread._i))
         self.FetcherThread.to_file = to_file
+
+    def run(self):
+        # archives are streamed to disk, which the async engine doesn't do
+        self.engine = "threads"
+        super().run()
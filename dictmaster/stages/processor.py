@@ -14,28 +14,81 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
 import re
+import math
 import sqlite3
+import warnings
+import itertools
+import collections
+import multiprocessing
 
-from dictmaster.util import CancelableThread, find_synonyms, FLAGS
+from dictmaster.util import CancelableThread, find_synonyms, warn_nl, format_bytes, FLAGS, \
+                            data_hash
 
 from pyquery import PyQuery as pq
 from lxml import etree
+import lxml.html
+
+# the processor that forked worker processes inherit from the parent process
+_worker_processor = None
+
+# seconds to wait for a batch before checking if the stage has been canceled
+_POLL_INTERVAL = 1.0
+
+# As of Python 3.12, os.fork() warns if the process has several threads, see
+# Processor.run_parallel why this is fine for the worker processes.
+warnings.filterwarnings("ignore", category=DeprecationWarning,
+    message=r"This process \(pid=\d+\) is multi-threaded, use of fork\(\) may lead to deadlocks in the child\.")
+
+# raw rows with any of these flags are not processed
+_SKIP_FLAGS = (
+    FLAGS["PROCESSED"]
+    | FLAGS["DUPLICATE"]
+    | FLAGS["ZIP_FETCHER"]
+    | FLAGS["URL_FETCHER"]
+)
+
+def _process_rows(rows):
+    try:
+        return _worker_processor.process_rows(rows), None
+    except BaseException as e:
+        # e.g. SystemExit, which would end the worker without sending a result
+        return None, e
 
 class Processor(CancelableThread):
     plugin = None
     auto_synonyms = True
     data = None
+    # number of worker processes, rows are processed in the stage thread if 1
+    processes = 1
+    # maximum number of rows sent to a worker process at a time
+    batch_size = 50
+    # rows read (and committed) at a time
+    chunk_size = 500
+    # entries buffered before they are sent to the database
+    flush_size = 5000
+    # leave reading FILE rows to process() instead of loading them into memory,
+    # such processors always run serially since a worker process would send
+    # back all the entries of a (possibly huge) file at once
+    stream_files = False
 
     _conn = None
     _c = None
     _curr_row = None
+    _entries = None
     _i = 0
+    _next_id = 1
+    _dict_rows = None
+    _syn_rows = None
+    _processed = None
 
-    def __init__(self, plugin, auto_synonyms=True):
+    def __init__(self, plugin, auto_synonyms=True, processes=1):
         super().__init__()
         self.plugin = plugin
         self.auto_synonyms = auto_synonyms
+        self.processes = processes
 
     def reset(self):
         conn = sqlite3.connect(self.plugin.output_db)
@@ -58,34 +111,191 @@ class Processor(CancelableThread):
     def run(self):
         self._conn = sqlite3.connect(self.plugin.output_db)
         self._conn.text_factory = str
-        self._conn.row_factory = sqlite3.Row
         self._c = self._conn.cursor()
         self._i = self._c.execute("SELECT COUNT(*) FROM dict").fetchone()[0]
-        curs = self._conn.cursor()
-        flag = (
-            FLAGS["PROCESSED"]
-            | FLAGS["DUPLICATE"]
-            | FLAGS["ZIP_FETCHER"]
-            | FLAGS["URL_FETCHER"]
-        )
-        for row in curs.execute(f"SELECT * FROM raw WHERE flag & {flag:d} == 0"):
-            self._curr_row = dict(row)
-            if self._curr_row["flag"] & FLAGS["FILE"]:
-                with open(self._curr_row["uri"],"rb") as f:
-                    self._curr_row["data"] = f.read()
-            elif self._curr_row["flag"] & FLAGS["MEMORY"]:
-                self.data_from_memory()
+        self._next_id = self._c.execute("SELECT COALESCE(MAX(id), 0) FROM dict").fetchone()[0] + 1
+        self._dict_rows, self._syn_rows, self._processed = [], [], []
+        rows = self.read_rows()
+        if self.processes > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            warn_nl("Parallel processing is not supported on this platform.")
+            self.processes = 1
+        if self.processes > 1 and self.stream_files:
+            warn_nl("Parallel processing is not supported by this plugin.")
+            self.processes = 1
+        try:
+            if self.processes > 1:
+                self.run_parallel(rows)
+            else:
+                self.run_serial(rows)
+        finally:
+            # close the reading connection in this thread, even on errors
+            rows.close()
+        self.commit()
+        self._conn.close()
+
+    def read_rows(self):
+        """
+        Iterate over the unprocessed rows as (id, uri, data, flag). The rows
+        are read in chunks (keyset pagination on id) from a separate connection
+        that doesn't hold a read lock while results are written. The results
+        are committed before the next chunk is read.
+        """
+        conn = sqlite3.connect(self.plugin.output_db)
+        conn.text_factory = str
+        last_id = -1
+        try:
+            while True:
+                if last_id >= 0:
+                    self.commit()
+                chunk = conn.execute(f'''
+                    SELECT id, uri, data, flag FROM raw
+                    WHERE id > ? AND flag & {_SKIP_FLAGS:d} == 0
+                    ORDER BY id LIMIT ?
+                ''', (last_id, self.chunk_size)).fetchall()
+                if len(chunk) == 0:
+                    break
+                last_id = chunk[-1][0]
+                yield from chunk
+        finally:
+            conn.close()
+
+    def count_rows(self):
+        """ Number of unprocessed rows """
+        return self._c.execute(f'''
+            SELECT COUNT(*) FROM raw WHERE flag & {_SKIP_FLAGS:d} == 0
+        ''').fetchone()[0]
+
+    def batches(self, rows, size):
+        """
+        Group `rows` into lists of at most `size` rows. FILE rows get a batch
+        of their own, since a single one might keep a worker busy for long.
+        """
+        batch = []
+        for row in rows:
+            if row[3] & FLAGS["FILE"]:
+                if len(batch) > 0:
+                    yield batch
+                    batch = []
+                yield [row]
+                continue
+            batch.append(row)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def run_serial(self, rows):
+        for row in rows:
+            self.load_row(row)
             self.process()
             if self._canceled:
-                self._c.execute('''
-                    DELETE FROM dict WHERE rawid=?
-                ''', (self._curr_row["id"],))
+                self.discard_row(self._curr_row["id"])
                 break
-            self._c.execute('''
-                UPDATE raw SET flag = flag | ? WHERE id=?
-            ''', (FLAGS["PROCESSED"], self._curr_row["id"]))
+            self.mark_processed(self._curr_row["id"])
+
+    def run_parallel(self, rows):
+        """
+        Process batches of rows in forked worker processes. The batches are
+        sized so that each worker gets about four of them, which keeps all of
+        the workers busy even if there are only a few rows. The results are
+        sent back per batch and written in the order of the rows, by this
+        thread only. Rows are only marked as processed together with their
+        entries, so that nothing is lost if the stage is canceled.
+
+        The workers are forked from this (stage) thread: locks held by other
+        threads at fork time stay locked in the children. Apart from this
+        thread, only the main thread is running (waiting for the plugin and
+        displaying the progress) and the workers only run process() on their
+        copy of the processor, so Python's warning about this is suppressed.
+
+        If process() raises (or exits) in a worker, the exception is raised in
+        this thread, like in serial mode.
+        """
+        global _worker_processor
+        _worker_processor = self
+        size = math.ceil(self.count_rows() / (4 * self.processes))
+        batches = self.batches(rows, max(1, min(self.batch_size, size)))
+        pending = collections.deque()
+        try:
+            with multiprocessing.get_context("fork").Pool(self.processes) as pool:
+                for batch in itertools.islice(batches, 2 * self.processes):
+                    pending.append(pool.apply_async(_process_rows, (batch,)))
+                while len(pending) > 0 and not self._canceled:
+                    try:
+                        results, exc = pending[0].get(_POLL_INTERVAL)
+                    except multiprocessing.TimeoutError:
+                        continue
+                    pending.popleft()
+                    if exc is not None:
+                        raise exc
+                    for rawid, uri, entries in results:
+                        self._curr_row = {"id": rawid, "uri": uri}
+                        for term, definition, alts in entries:
+                            self.write_entry(term, definition, alts, rawid)
+                        self.mark_processed(rawid)
+                    for batch in itertools.islice(batches, 1):
+                        pending.append(pool.apply_async(_process_rows, (batch,)))
+        finally:
+            _worker_processor = None
+
+    def process_rows(self, rows):
+        """ Process rows in a worker process, return the entries per row """
+        results = []
+        for row in rows:
+            self._entries = []
+            self.load_row(row)
+            self.process()
+            results.append((row[0], row[1], self._entries))
+        return results
+
+    def load_row(self, row):
+        rawid, uri, data, flag = row
+        self._curr_row = {"id": rawid, "uri": uri, "data": data, "flag": flag}
+        if self._curr_row["flag"] & FLAGS["FILE"]:
+            if not self.stream_files:
+                with open(self._curr_row["uri"],"rb") as f:
+                    self._curr_row["data"] = f.read()
+        elif self._curr_row["flag"] & FLAGS["MEMORY"]:
+            self.data_from_memory()
+
+    def mark_processed(self, rawid):
+        self._processed.append((FLAGS["PROCESSED"], rawid))
+        if len(self._processed) >= self.flush_size:
+            self.flush()
+
+    def discard_row(self, rawid):
+        """ Drop the entries of a row that was only processed partially """
+        wids = set(r[0] for r in self._dict_rows if r[3] == rawid)
+        self._dict_rows = [r for r in self._dict_rows if r[3] != rawid]
+        self._syn_rows = [r for r in self._syn_rows if r[0] not in wids]
+        self.flush()
+        self._c.execute('''
+            DELETE FROM synonyms
+            WHERE wid IN (SELECT id FROM dict WHERE rawid=?)
+        ''', (rawid,))
+        self._c.execute('''
+            DELETE FROM dict WHERE rawid=?
+        ''', (rawid,))
+
+    def commit(self):
+        self.flush()
         self._conn.commit()
-        self._conn.close()
+
+    def flush(self):
+        """ Send buffered entries and flags to the database (without commit) """
+        self._c.executemany('''
+            INSERT INTO dict(id,word,def,rawid,def_hash)
+            VALUES (?,?,?,?,?)
+        ''', self._dict_rows)
+        self._c.executemany('''
+            INSERT INTO synonyms(wid,syn)
+            VALUES (?,?)
+        ''', self._syn_rows)
+        self._c.executemany('''
+            UPDATE raw SET flag = flag | ? WHERE id=?
+        ''', self._processed)
+        self._dict_rows, self._syn_rows, self._processed = [], [], []
 
     def data_from_memory(self):
         self._curr_row["data"] = self.data[self._curr_row["uri"]]
@@ -103,18 +313,27 @@ class Processor(CancelableThread):
         if self.auto_synonyms:
             alts = find_synonyms(term,definition,alts)
         alts = [a for a in set(alts) if a != term]
-        self._c.execute('''
-            INSERT INTO dict(word,def,rawid)
-            VALUES (?,?,?)
-        ''', (term, definition, self._curr_row["id"]))
-        tmp_id = self._c.lastrowid
-        self._c.executemany('''
-            INSERT INTO synonyms(wid,syn)
-            VALUES (?,?)
-        ''', [(tmp_id, a) for a in alts])
+        if self._entries is not None:
+            # worker process, the parent process writes the entry
+            self._entries.append((term, definition, alts))
+        else:
+            self.write_entry(term, definition, alts, self._curr_row["id"])
+
+    def write_entry(self, term, definition, alts, rawid):
+        wid = self._next_id
+        self._next_id += 1
+        self._dict_rows.append((wid, term, definition, rawid, data_hash(definition)))
+        self._syn_rows += [(wid, a) for a in alts]
         self._i += 1
+        if len(self._dict_rows) >= self.flush_size:
+            self.flush()
 
 class DictfileProcessor(Processor):
+    stream_files = True
+
+    _bytes_read = 0
+    _bytes_total = 0
+
     def __init__(self, plugin,
             fieldSplit="\t",
             subfieldSplit=None,
@@ -127,13 +346,31 @@ class DictfileProcessor(Processor):
         self.subsubfieldSplit = subsubfieldSplit
         self.flipCols = flipCols
 
+    def progress(self):
+        if self._curr_row == None or self._canceled or self._bytes_total == 0:
+            return Processor.progress(self)
+        return "Processing... {} of {}: {}".format(
+            format_bytes(self._bytes_read), format_bytes(self._bytes_total), self._i
+        )
+
+    def open_row(self):
+        """ Binary file object with the data of the current row """
+        if self._curr_row["flag"] & FLAGS["FILE"]:
+            self._bytes_total = os.path.getsize(self._curr_row["uri"])
+            return open(self._curr_row["uri"], "rb")
+        self._bytes_total = len(self._curr_row["data"])
+        return io.BytesIO(self._curr_row["data"])
+
     def process(self):
-        data = self._curr_row["data"].decode("utf-8")
-        for line in data.split("\n"):
-            if self._canceled:
-                 break
-            line = line.strip().replace("\u2028","")
-            self.do_line(line)
+        self._bytes_read = 0
+        with self.open_row() as f:
+            # UTF-8 never has b"\n" inside of a multi-byte sequence
+            for line in f:
+                if self._canceled:
+                     break
+                self._bytes_read += len(line)
+                line = line.decode("utf-8").strip().replace("\u2028","")
+                self.do_line(line)
 
     def do_line(self, line):
         entries = []
@@ -229,12 +466,38 @@ class HtmlABProcessor(HtmlProcessor):
 
     def do_html(self, doc):
         dt = doc(self.AB[0])
-        while len(dt) > 0:
+        if len(dt) == 0:
+            return
+        # The first B is searched among the siblings following any A, but the
+        # siblings of a parent only need to be scanned from its first A on.
+        dd, parents = doc([]), set()
+        for el in dt:
+            if el.getparent() in parents:
+                continue
+            parents.add(el.getparent())
+            dd = doc(el).nextAll(self.AB[1])
+            if len(dd) > 0:
+                break
+        if len(dd) == 0:
+            self.append(doc(dt[0]), doc([]))
+            return
+        # All further pairs are siblings of the first B: pair each A with the
+        # next B in a single walk over them.
+        is_a, is_b = set(dd.eq(0).nextAll(self.AB[0])), set(dd)
+        pairs, dt = [(dt[0], dd[0])], None
+        for el in dd[0].itersiblings():
+            if dt is None:
+                if el in is_a:
+                    dt = el
+            elif el in is_b:
+                pairs.append((dt, el))
+                dt = None
+        if dt is not None:
+            pairs.append((dt, None))
+        for dt, dd in pairs:
             if self._canceled:
                  break
-            dt, dd = dt.eq(0), dt.nextAll(self.AB[1]).eq(0)
-            self.append(doc(dt), doc(dd))
-            dt = dd.nextAll(self.AB[0])
+            self.append(doc(dt), doc([] if dd is None else dd))
 
 class HtmlAXProcessor(HtmlProcessor):
     def __init__(self, A, plugin, charset="utf-8", auto_synonyms=True):
@@ -243,22 +506,49 @@ class HtmlAXProcessor(HtmlProcessor):
 
     def do_html(self, doc):
         dt = doc(self.A)
-        while len(dt) > 0:
+        if len(dt) == 0:
+            return
+        dts = [dt[0]] + list(dt.eq(0).nextAll(self.A))
+        parent = dts[0].getparent()
+        siblings = [dts[0]] if parent is None else list(parent)
+        start = siblings.index(dts[0])
+        # Unless it's the only one, the first entry also gets the
+        # elements in front of it.
+        entries, dd = [], siblings[:start] if len(dts) > 1 else []
+        is_dt = set(dts)
+        for el in siblings[start + 1:]:
+            if el in is_dt:
+                entries.append((dts[len(entries)], dd))
+                dd = []
+            else:
+                dd.append(el)
+        entries.append((dts[-1], dd))
+        for dt, dd in entries:
             if self._canceled:
                  break
-            dt = dt.eq(0)
-            dt_html = dt.outer_html()
-            next_dt = dt.nextAll(self.A)
-            if len(next_dt) > 0:
-                dt.remove()
-                dd = next_dt.eq(0).prevAll()
-                dd_html = ''.join(doc(d).outer_html() for d in dd)
-                dd.remove()
-            else:
-                dd = dt.nextAll()
-                dd_html = ''.join(doc(d).outer_html() for d in dd)
-            self.append(pq(dt_html), pq(dd_html))
-            dt = next_dt
+            self.append(self.detach([dt]), self.detach(dd))
+
+    @staticmethod
+    def detach(nodes):
+        """
+        Detach the elements among `nodes` from the document. Several elements
+        are wrapped into a <div> (or <span>) like lxml.html does when parsing
+        a fragment. Comments in between are dropped.
+        """
+        elements = [node for node in nodes if isinstance(node.tag, str)]
+        for el in elements:
+            if el.getparent() is not None:
+                el.getparent().remove(el)
+            el.tail = None
+        if len(elements) == 0:
+            return pq([])
+        elif len(elements) == 1:
+            return pq(elements[0])
+        block = any(e.tag in lxml.html.defs.block_tags
+                    for el in elements for e in el.iter(etree.Element))
+        wrapper = etree.Element("div" if block else "span")
+        wrapper.extend(elements)
+        return pq(wrapper)
 
 class HtmlContainerProcessor(HtmlProcessor):
     container_tag = "div"
@@ -22,12 +22,9 @@ from dictmaster.stages.fetcher import Fetcher
 class UrlFetcher(Fetcher):
     class FetcherThread(Fetcher.FetcherThread):
         _output_flag = FLAGS["RAW_FETCHER"]
-        def fetch_uri(self, rawid, uri):
+        def store_filtered(self, rawid, uri, urls):
             self._i += 1
-            data = self.download_retry(self.parse_uri(uri), self.postdata)
-            if self._canceled:
-                 return
-            for url in self.filter_data(data, uri):
+            for url in urls:
                 self._queue.put((None, url, None, self._output_flag))
             self._queue.put((rawid, uri, None, self._flag))
 
@@ -0,0 +1,172 @@
+# This file is part of dictmaster
+# Copyright (C) 2018  Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import struct
+import time
+import zlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from dictmaster.util import warn_nl
+
+# the chunk length used by the reference dictzip implementation: even
+# incompressible chunks fit into the 16 bit size fields after deflate
+DICTZIP_CHUNK_SIZE = 58315
+# the RA extra field (and thus the chunk table) is limited to 64 KiB
+DICTZIP_MAX_CHUNKS = (0xFFFF - 10) // 2
+
+_re_newline = re.compile("\n\r?|\r\n?")
+
+def sort_key(word):
+    """ StarDict order: ASCII case-insensitive, ties broken bytewise """
+    return word.encode("utf-8").lower()
+
+def _compress_chunk(chunk, last):
+    # every chunk is a deflate stream of its own, ending on a byte boundary,
+    # so that it can be inflated without its predecessors
+    c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(chunk) + c.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+def dictzip(path, chunk_size=DICTZIP_CHUNK_SIZE, workers=None):
+    """
+    Compress `path` into `path`.dz (gzip with random access) and remove it.
+    Raises ValueError if `path` has more than DICTZIP_MAX_CHUNKS chunks.
+
+    Smaller chunks make lookups cheaper but compress worse. The chunks are
+    compressed on `workers` threads (zlib releases the GIL), default: one
+    per CPU. Only a few chunks per worker are kept in memory.
+    """
+    if not 0 < chunk_size <= DICTZIP_CHUNK_SIZE:
+        raise ValueError(f"dictzip chunk size must be between 1 and {DICTZIP_CHUNK_SIZE}")
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(path)
+    chcnt = max(1, -(-size // chunk_size))
+    if chcnt > DICTZIP_MAX_CHUNKS:
+        raise ValueError(f"{path} is too big for dictzip ({size} bytes)")
+    extra = struct.pack("<2sHHHH", b"RA", 6 + 2 * chcnt, 1, chunk_size, chcnt)
+    header = struct.pack("<BBBBIBBH", 0x1f, 0x8b, 8, 4, int(time.time()), 2, 3,
+                         len(extra) + 2 * chcnt) + extra
+    sizes, crc, pending = [], 0, collections.deque()
+    with open(path, "rb") as f_in, open(path + ".dz", "wb") as f_out, \
+         ThreadPoolExecutor(max_workers=workers) as pool:
+        def write_next():
+            data = pending.popleft().result()
+            sizes.append(len(data))
+            f_out.write(data)
+        # chunk sizes are filled in after compression
+        f_out.write(header + bytes(2 * chcnt))
+        for i in range(chcnt):
+            chunk = f_in.read(chunk_size)
+            crc = zlib.crc32(chunk, crc)
+            pending.append(pool.submit(_compress_chunk, chunk, i == chcnt - 1))
+            if len(pending) >= 2 * workers:
+                write_next()
+        while pending:
+            write_next()
+        f_out.write(struct.pack("<II", crc, size & 0xFFFFFFFF))
+        f_out.seek(len(header))
+        f_out.write(struct.pack(f"<{chcnt}H", *sizes))
+    os.remove(path)
+
+class StarDictWriter(object):
+    """
+    Writes a StarDict dictionary (.ifo, .idx, .dict and .syn) while iterating
+    over the entries, so that only a single entry is held in memory.
+
+    Entries and synonyms have to be passed in StarDict order (see `sort_key`).
+    Definitions are stored in the format `sametypesequence` ("h" for HTML,
+    "m" for plain text); any other format is stored with a type per entry.
+    """
+    basename = ""
+    bookname = ""
+    sametypesequence = "h"
+    dictzip = True
+    dictzip_chunk_size = DICTZIP_CHUNK_SIZE
+    dictzip_workers = None
+    wordcount = 0
+    synwordcount = 0
+
+    def __init__(self, basename, bookname, sametypesequence="h", dictzip=True,
+                 dictzip_chunk_size=DICTZIP_CHUNK_SIZE, dictzip_workers=None):
+        self.basename = basename
+        self.bookname = bookname
+        self.sametypesequence = sametypesequence
+        self.dictzip = dictzip
+        self.dictzip_chunk_size = dictzip_chunk_size
+        self.dictzip_workers = dictzip_workers
+
+    def write(self, entries, synonyms):
+        """
+        Write `entries`, an iterable of (word, definition), and `synonyms`,
+        an iterable of (synonym, index of the entry it refers to).
+        """
+        for ext in (".syn", ".dict.dz"):
+            # leftovers of an earlier export
+            if os.path.exists(self.basename + ext):
+                os.remove(self.basename + ext)
+        compact = self.sametypesequence in ("h", "m")
+        typ = self.sametypesequence if self.sametypesequence in ("h", "m", "x") else "m"
+        offset, self.wordcount = 0, 0
+        with open(self.basename + ".idx", "wb") as f_idx, \
+             open(self.basename + ".dict", "wb") as f_dict:
+            for word, definition in entries:
+                if compact:
+                    data = definition.encode("utf-8")
+                else:
+                    data = (typ + definition).encode("utf-8") + b"\x00"
+                if offset + len(data) > 0xFFFFFFFF:
+                    raise ValueError("Dictionary too big for 32 bit offsets")
+                f_dict.write(data)
+                f_idx.write(word.encode("utf-8") + b"\x00"
+                            + struct.pack(">II", offset, len(data)))
+                offset += len(data)
+                self.wordcount += 1
+        self.synwordcount = 0
+        f_syn = None
+        try:
+            for syn, index in synonyms:
+                if f_syn is None:
+                    f_syn = open(self.basename + ".syn", "wb")
+                f_syn.write(syn.encode("utf-8") + b"\x00" + struct.pack(">I", index))
+                self.synwordcount += 1
+        finally:
+            if f_syn is not None:
+                f_syn.close()
+        self.write_ifo()
+        if self.dictzip:
+            try:
+                dictzip(self.basename + ".dict", self.dictzip_chunk_size, self.dictzip_workers)
+            except ValueError as e:
+                # raised before anything is written
+                warn_nl("{}, keeping the uncompressed .dict file.".format(e))
+
+    def write_ifo(self):
+        ifo = [
+            ("version", "3.0.0"),
+            ("bookname", _re_newline.sub(" ", self.bookname)),
+            ("wordcount", self.wordcount),
+            ("idxfilesize", os.path.getsize(self.basename + ".idx")),
+        ]
+        if self.sametypesequence in ("h", "m"):
+            ifo.append(("sametypesequence", self.sametypesequence))
+        if self.synwordcount > 0:
+            ifo.append(("synwordcount", self.synwordcount))
+        ifo.append(("description", ""))
+        with open(self.basename + ".ifo", "w", encoding="utf-8", newline="\n") as f:
+            f.write("StarDict's dict ifo file\n")
+            f.writelines(f"{key}={value}\n" for key, value in ifo)
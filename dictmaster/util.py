@@ -20,6 +20,12 @@ import os
 import errno
 import sqlite3
 import random
+import hashlib
+import socket
+import ssl
+import zlib
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urljoin
 
 try:
     from urllib2 import URLError, HTTPError
@@ -29,6 +35,11 @@ except ImportError:
     import urllib.request as urllib2
     import http.client as httplib
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import pkgutil
 import importlib
 
@@ -58,6 +69,46 @@ URL_HEADER = {
     "User-Agent": "Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:87.0) Gecko/20100101 Firefox/87.0",
 }
 
+ACCEPT_ENCODING = "gzip, deflate" if brotli is None else "gzip, deflate, br"
+
+DEFAULT_POOLSIZE = 8
+MAX_REDIRECTS = 10
+
+def data_hash(data):
+    """ Fixed-size digest of page data or definitions, used for duplicate detection """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    elif not isinstance(data, bytes):
+        return None
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def decode_content(data, encoding):
+    """ Undo the Content-Encoding of a response body """
+    encoding = (encoding or "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        # gzip member header and trailer, possibly several members
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = d.decompress(data)
+        while d.unused_data:
+            data = d.unused_data
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += d.decompress(data)
+        return out
+    elif encoding == "deflate":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # some servers send raw deflate streams without zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    elif encoding == "br" and brotli is not None:
+        return brotli.decompress(data)
+    elif encoding == "identity":
+        return data
+    raise ValueError(f"Unsupported Content-Encoding '{encoding}'")
+
+def format_bytes(n):
+    return "{:.1f} MB".format(n / 1000000.0)
+
 def warn_nl(msg):
     sys.stdout.write("\r\n{}\n".format(msg))
     sys.stdout.flush()
@@ -139,6 +190,258 @@ def html_container_filter(container, charset="utf-8", bad_content=None):
              return doc(container).html()
     return tmp_func
 
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP(S) connections keyed by scheme, host
+    and port. At most `size` idle connections are kept per host.
+
+    Requests that have to go through a proxy (http_proxy etc.) are left to
+    urllib, just like other schemes than http(s).
+    """
+    size = DEFAULT_POOLSIZE
+    requests = 0
+    reused = 0
+    received = 0
+    decoded = 0
+
+    _idle = None
+    _lock = None
+    _ssl_context = None
+    _proxies = None
+
+    def __init__(self, size=DEFAULT_POOLSIZE):
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+        self._proxies = urllib2.getproxies()
+
+    def _get(self, key, timeout):
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get(key, [])
+            if len(idle) > 0:
+                self.reused += 1
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout,
+                                           context=self._ssl_context)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def count_bytes(self, received, decoded):
+        """ Record the size of a response body on the wire and after decoding """
+        with self._lock:
+            self.received += received
+            self.decoded += decoded
+
+    def release(self, response):
+        """ Return the response's connection to the pool (body must be consumed) """
+        if not hasattr(response, "pool_conn"):
+            response.close()
+            return
+        key, conn = response.pool_key, response.pool_conn
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, response):
+        """ Close the response's connection, e.g. after a failed read """
+        getattr(response, "pool_conn", response).close()
+
+    def _read_release(self, response):
+        try:
+            response.read()
+        except:
+            self.discard(response)
+            raise
+        self.release(response)
+
+    def _use_urllib(self, parts):
+        if parts.scheme not in ("http", "https"):
+            return True
+        return parts.scheme in self._proxies \
+            and not urllib2.proxy_bypass(parts.netloc)
+
+    def _request(self, key, method, path, data, headers, timeout):
+        conn, reused = self._get(key, timeout)
+        try:
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except (ConnectionError, httplib.BadStatusLine):
+                if not reused:
+                    raise
+                # stale keep-alive connection, retry on a fresh one
+                conn.close()
+                conn.connect()
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        response.pool_key, response.pool_conn = key, conn
+        return response
+
+    def urlopen(self, url, data=None, timeout=60, headers=None):
+        """
+        Open `url`, following redirects. Raises HTTPError for error codes.
+        The caller is expected to read the response and then call `release`.
+        """
+        extra_headers = headers or {}
+        for _ in range(MAX_REDIRECTS):
+            parts = urlsplit(url)
+            if self._use_urllib(parts):
+                req = urllib2.Request(url, data=data,
+                                      headers=dict(URL_HEADER, **extra_headers))
+                return urllib2.urlopen(req, timeout=timeout)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            headers = dict(URL_HEADER, **extra_headers)
+            method = "GET"
+            if data is not None:
+                method = "POST"
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+            response = self._request(key, method, path, data, headers, timeout)
+            if response.status < 300 or response.status >= 400 \
+            or response.getheader("Location") is None:
+                break
+            self._read_release(response)
+            url = urljoin(url, response.getheader("Location"))
+            if response.status == 303 \
+            or (response.status in (301, 302) and method == "POST"):
+                data = None
+        else:
+            # the last response has been released already
+            raise HTTPError(url, response.status, "too many redirects",
+                            response.msg, None)
+        if response.status >= 300:
+            self._read_release(response)
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, None)
+        return response
+
+CONNECTION_POOL = ConnectionPool()
+
+class RateLimiter(object):
+    """
+    Token bucket per host: on average at most `rate` requests per second
+    with bursts of up to `burst` requests. Shared by all threads of a plugin.
+    """
+    rate = 1.0
+    burst = 1
+
+    _buckets = None
+    _lock = None
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, url):
+        """ Take a token for the host of `url`, return seconds to wait for it """
+        host = urlsplit(url).hostname
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate) - 1
+            self._buckets[host] = (tokens, now)
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+class RetriesExhausted(Exception):
+    """ Raised by download_retry when a download is postponed to a later round """
+    def __init__(self, url, retry_after=None):
+        super().__init__(f"Giving up on {url} for now")
+        self.url, self.retry_after = url, retry_after
+
+class NotModified(Exception):
+    """ Raised by download_retry if the data stored for a page is up to date """
+    def __init__(self, url):
+        super().__init__(f"{url} not modified")
+        self.url = url
+
+def parse_retry_after(value):
+    """ Seconds to wait according to a Retry-After header (or None) """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+class RetryPolicy(object):
+    """
+    Decides if and when a failed download is retried.
+
+    The n-th retry waits `random.uniform(*sleep) * 2**(n-1)` seconds (at most
+    `max_delay`), or as long as the server asks for in its Retry-After header.
+    After `max_attempts` attempts (or if the server asks for more than
+    `max_delay`), the download is postponed to a later round of the fetcher,
+    and after `max_rounds` such rounds it is given up for this run.
+
+    `rules` maps HTTP status codes to "retry", "skip" (store empty data) or
+    "defer" (postpone to the next round right away).
+    """
+    max_attempts = 6
+    max_rounds = 3
+    max_delay = 600.0
+    rules = {403: "skip", 404: "skip"}
+
+    def __init__(self, max_attempts=6, max_rounds=3, max_delay=600.0, rules=None):
+        self.max_attempts = max_attempts
+        self.max_rounds = max_rounds
+        self.max_delay = max_delay
+        self.rules = dict(RetryPolicy.rules)
+        if rules is not None:
+            self.rules.update(rules)
+
+    def action(self, status):
+        return self.rules.get(status, "retry")
+
+    def _max_delay(self, sleep):
+        # a single wait of the plugin's `sleep` is never cut short
+        return max(self.max_delay, sleep[1])
+
+    def delay(self, attempt, sleep, retry_after=None):
+        """
+        Seconds to wait after the failed attempt no. `attempt`, or None if the
+        download should be postponed to the next round instead
+        """
+        max_delay = self._max_delay(sleep)
+        if attempt >= self.max_attempts \
+        or (retry_after is not None and retry_after > max_delay):
+            return None
+        delay = min(max_delay, random.uniform(*sleep) * 2**(attempt - 1))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def round_delay(self, rnd, sleep, retry_after=None):
+        """ Seconds until a download postponed in round no. `rnd` is due """
+        # continue the backoff where the last round's attempts left off
+        attempt = self.max_attempts + rnd - 1
+        delay = min(self._max_delay(sleep), random.uniform(*sleep) * 2**(attempt - 1))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
 """
 The CancelableThread is a convenience class that all threads in dictmaster
 are instances of. Apart from the cancel() method it provides convenient access
@@ -147,12 +450,25 @@ to a (cancelable and feedback providing) download method.
 class CancelableThread(threading.Thread):
     _canceled = False
     _download_status = ""
-    _retry403 = False
-    _retry404 = False
 
-    def __init__(self, sleep=(1.0, 3.0)):
+    sleep = (1.0, 3.0)
+    retry_policy = RetryPolicy()
+    pool = CONNECTION_POOL
+    limiter = None
+    controller = None
+    cache = None
+
+    def __init__(self, sleep=(1.0, 3.0), pool=None, limiter=None, controller=None,
+                 retry_policy=None, cache=None):
         super().__init__()
         self.sleep = sleep
+        if retry_policy is not None:
+            self.retry_policy = retry_policy
+        if pool is not None:
+            self.pool = pool
+        self.limiter = limiter
+        self.controller = controller
+        self.cache = cache
         self.daemon = True
 
     def progress(self):
@@ -162,8 +478,10 @@ class CancelableThread(threading.Thread):
 
     def cancel(self): self._canceled = True
 
-    def _chunk_download(self, response, total_size):
-        data, chunk_size = b"", 2**16
+    def _chunk_download(self, response, total_size, f=None):
+        """ Read the response in chunks, into memory or into the file `f` """
+        data, size, chunk_size = bytearray(), 0, 2**16
+        write = data.extend if f is None else f.write
         while True:
             if self._canceled:
                 data = None
@@ -171,51 +489,153 @@ class CancelableThread(threading.Thread):
             chunk = response.read(chunk_size)
             if not chunk:
                  break
-            data += chunk
+            write(chunk)
+            size += len(chunk)
             self._download_status = "Downloading... {: 6d} of {: 6d} KB".format(
-                int(len(data)/1000), int(total_size/1000)
+                int(size/1000), int(total_size/1000)
             )
         self._download_status = ""
-        return data
+        if data is not None and size < total_size:
+            # read() doesn't complain if the connection is closed early
+            raise httplib.IncompleteRead(b"", total_size - size)
+        if data is None or f is not None:
+            return data
+        return bytes(data)
 
-    def download_retry(self, url, params=None, timeout=60):
-        if self._canceled:
-            return None
+    def _download_to_file(self, response, total_size, dest):
+        part = dest + ".part"
+        f = open(part, "wb")
         try:
-            req = urllib2.Request(url, data=params, headers=URL_HEADER)
-            try: response = urllib2.urlopen(req, timeout=timeout)
-            except HTTPError as e:
-                if e.code == 404 and not self._retry404:
-                    warn_nl(f"Not found ({e.code}): {url}")
-                    return b""
-                elif e.code == 403 and not self._retry403:
-                    warn_nl(f"Forbidden ({e.code}): {url}")
-                    return b""
-                else:
+            with f:
+                result = self._chunk_download(response, total_size, f)
+        except:
+            # don't leave failed downloads behind
+            os.remove(part)
+            raise
+        if result is None:
+            os.remove(part)
+            return None
+        os.replace(part, dest)
+        return dest
+
+    def wait_for_limiter(self, url):
+        if self.limiter is None:
+            return
+        sleep_time = self.limiter.reserve(url)
+        while sleep_time > 0 and not self._canceled:
+            time.sleep(min(sleep_time, 1))
+            sleep_time -= 1
+
+    def report(self, status, t_start):
+        """ Feed the outcome of a request to the concurrency controller """
+        if self.controller is not None:
+            self.controller.record(time.monotonic() - t_start, status)
+
+    def download_retry(self, url, params=None, timeout=60, dest=None, stored=None,
+                       slot=None):
+        """
+        Download `url`, retrying according to `retry_policy`. Raises
+        RetriesExhausted if the download should be postponed.
+
+        If `dest` is given, the data is streamed to that file and `dest` is
+        returned instead of the data.
+
+        `stored` is the digest of the data that was stored for `url` earlier.
+        If the HTTP cache can tell that it's up to date, NotModified is raised.
+
+        `slot` is the caller's worker slot of the concurrency controller, it
+        is given up while waiting for a retry.
+        """
+        policy = self.retry_policy
+        cache = self.cache if params is None and dest is None else None
+        headers, cached = {}, None
+        if cache is not None:
+            headers, cached = cache.validators(url, stored)
+        conditional = len(headers) > 0
+        if dest is None:
+            # streamed downloads are written to disk as they are
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
+        attempt = 0
+        while not self._canceled:
+            attempt += 1
+            self.wait_for_limiter(url)
+            if self._canceled:
+                break
+            t_start = time.monotonic()
+            retry_after, action = None, "retry"
+            try:
+                try:
+                    response = self.pool.urlopen(url, params, timeout=timeout,
+                                                 headers=headers)
+                except HTTPError as e:
+                    self.report(e.code, t_start)
+                    if e.code == 304 and conditional:
+                        cache.not_modified()
+                        if cached is None:
+                            raise NotModified(url)
+                        return cached
+                    action = policy.action(e.code)
+                    if action == "skip":
+                        reason = httplib.responses.get(e.code, "HTTP Error")
+                        warn_nl(f"{reason} ({e.code}): {url}")
+                        return b""
+                    if e.headers is not None:
+                        retry_after = parse_retry_after(e.headers.get("Retry-After"))
                     raise
-            total_size = response.info()['Content-Length']
-            if total_size != None:
-                 total_size = int(total_size.strip())
-            else:
-                 total_size = 0
-            if total_size > 5 * 2**16:
-                print("\nDownloading large file ({:.2f} MB)!".format(total_size/1000000.0))
-                data = self._chunk_download(response, total_size)
-            else:
-                 data = response.read()
-            return data
-        except Exception as e:
-            sleep_time = random.uniform(*self.sleep)
-            if isinstance(e, URLError) or isinstance(e, httplib.BadStatusLine):
-                warn_str = f"Connection to {url} failed. "
-            else:
-                warn_str = f"Error on {url}: '{e}'. "
-            warn_str += f"Retrying in {sleep_time:.1f} sec..."
-            warn_nl(warn_str)
-            while sleep_time > 0:
-                if self._canceled:
+                try:
+                    total_size = response.info()['Content-Length']
+                    if total_size != None:
+                         total_size = int(total_size.strip())
+                    else:
+                         total_size = 0
+                    if total_size > 5 * 2**16:
+                        print("\nDownloading large file ({:.2f} MB)!".format(total_size/1000000.0))
+                    if dest is not None:
+                        data = self._download_to_file(response, total_size, dest)
+                    elif total_size > 5 * 2**16:
+                        data = self._chunk_download(response, total_size)
+                    else:
+                         data = response.read()
+                except:
+                    # the connection is in an unknown state
+                    self.pool.discard(response)
+                    raise
+                self.pool.release(response)
+                if dest is None and data is not None:
+                    received = len(data)
+                    data = decode_content(data, response.info().get("Content-Encoding"))
+                    self.pool.count_bytes(received, len(data))
+                self.report(getattr(response, "status", None), t_start)
+                if cache is not None and data is not None:
+                    info = response.info()
+                    cache.store(url, info.get("ETag"), info.get("Last-Modified"), data)
+                return data
+            except NotModified:
+                raise
+            except Exception as e:
+                if isinstance(e, socket.timeout) \
+                or isinstance(getattr(e, "reason", None), socket.timeout):
+                    self.report("timeout", t_start)
+                elif not isinstance(e, HTTPError):
+                    self.report("error", t_start)
+                if isinstance(e, (URLError, OSError, httplib.HTTPException)):
+                    warn_str = f"Connection to {url} failed. "
+                else:
+                    warn_str = f"Error on {url}: '{e}'. "
+                sleep_time = None
+                if action != "defer":
+                    sleep_time = policy.delay(attempt, self.sleep, retry_after)
+                if sleep_time is None:
+                    warn_nl(warn_str + "Postponed to the next round.")
+                    raise RetriesExhausted(url, retry_after) from e
+                warn_nl(warn_str + f"Retrying in {sleep_time:.1f} sec...")
+                if slot is not None:
+                    slot.release()
+                while sleep_time > 0:
+                    if self._canceled:
+                        return None
+                    time.sleep(min(sleep_time, 1))
+                    sleep_time -= 1
+                if slot is not None and not slot.acquire(self):
                     return None
-                time.sleep(min(sleep_time, 1))
-                sleep_time -= 1
-            return self.download_retry(url, params)
-
+        return None
@@ -25,6 +25,9 @@ setup(
         "html5lib",
         "pyglossary",
     ],
+    extras_require={
+        "brotli": ["brotli"],
+    },
     scripts=["bin/dictmaster"],
     project_urls={ 'Source': 'https://framagit.org/tuxor1337/dictmaster', },
 )
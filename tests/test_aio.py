@@ -0,0 +1,44 @@
+import asyncio
+import sqlite3
+
+from dictmaster.aio import AsyncHttpClient
+from dictmaster.util import FLAGS
+from dictmaster.plugin import BasePlugin
+from dictmaster.queue import RawDbQueue
+from dictmaster.stages.fetcher import Fetcher
+
+def test_connection_reused(stub_server):
+    client = AsyncHttpClient(pool_size=2)
+    async def fetch():
+        try:
+            return [await client.request(stub_server.url + path) for path in ("/a", "/b")]
+        finally:
+            await client.close()
+    (status_a, _, body_a), (status_b, _, body_b) = asyncio.run(fetch())
+    assert (status_a, body_a) == (200, b"<p>/a</p>")
+    assert (status_b, body_b) == (200, b"<p>/b</p>")
+    assert (client.requests, client.reused) == (2, 1)
+    assert stub_server.connections == 1
+
+def test_proxy_fallback(tmp_path, stub_server, no_proxy, monkeypatch):
+    monkeypatch.setenv("http_proxy", stub_server.url)
+    class ProxiedFetcher(Fetcher):
+        class FetcherThread(Fetcher.FetcherThread):
+            def parse_uri(self, uri):
+                return "http://dictmaster.invalid/" + uri
+        def init_queue(self):
+            self._queue = RawDbQueue(self.plugin.output_db, batch_timeout=0)
+    plugin = BasePlugin(str(tmp_path))
+    conn = sqlite3.connect(plugin.output_db)
+    conn.executemany("INSERT INTO raw(uri,flag) VALUES (?,?)",
+                     [(str(i), FLAGS["RAW_FETCHER"]) for i in range(3)])
+    conn.commit()
+    fetcher = ProxiedFetcher(plugin, engine="async", concurrency=2)
+    fetcher.start()
+    fetcher.join()
+    data = [row[0] for row in conn.execute("SELECT data FROM raw ORDER BY id")]
+    conn.close()
+    # the stub server answers as a proxy would, with the full url as path
+    assert data == [b"<p>http://dictmaster.invalid/%d</p>" % i for i in range(3)]
+    assert fetcher._pool.requests == 0
+    assert fetcher._pool.received == fetcher._pool.decoded == sum(len(d) for d in data)
@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+from dictmaster.util import FLAGS
+from dictmaster.plugin import BasePlugin
+from dictmaster.queue import RawDbQueue
+from dictmaster.stages.fetcher import Fetcher, StoredDigests
+
+def make_plugin(tmp_path, stub_server, n):
+    class StubFetcher(Fetcher):
+        class FetcherThread(Fetcher.FetcherThread):
+            def parse_uri(self, uri):
+                return stub_server.url + "/etag/" + uri
+            def filter_data(self, data, uri):
+                return data.upper()
+        def init_queue(self):
+            self._queue = RawDbQueue(self.plugin.output_db, batch_timeout=0)
+    plugin = BasePlugin(str(tmp_path))
+    conn = sqlite3.connect(plugin.output_db)
+    conn.executemany("INSERT INTO raw(uri,flag) VALUES (?,?)",
+                     [(str(i), FLAGS["RAW_FETCHER"]) for i in range(n)])
+    conn.commit()
+    conn.close()
+    return plugin, StubFetcher
+
+def fetch(plugin, fetcher_cls, engine):
+    fetcher = fetcher_cls(plugin, threadcnt=2, engine=engine, concurrency=2)
+    fetcher.start()
+    fetcher.join()
+    conn = sqlite3.connect(plugin.output_db)
+    rows = conn.execute("SELECT id, uri, data, flag FROM raw ORDER BY id").fetchall()
+    conn.close()
+    return fetcher, rows
+
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_refetch_unchanged(tmp_path, stub_server, engine):
+    plugin, fetcher_cls = make_plugin(tmp_path, stub_server, 5)
+    plugin.enable_http_cache()
+    fetcher, rows = fetch(plugin, fetcher_cls, engine)
+    assert stub_server.bodies == 5
+    assert sum(s._i for s in fetcher._subthreads) == 5
+    assert rows[0][2] == b"<P>/ETAG/0</P>"
+    fetcher.reset()
+    fetcher, refetched = fetch(plugin, fetcher_cls, engine)
+    assert stub_server.bodies == 5
+    assert plugin.http_cache.unchanged == 5
+    assert refetched == rows
+    # the pages are not duplicated in the cache
+    conn = sqlite3.connect(plugin.http_cache.db_file)
+    assert conn.execute("SELECT COUNT(*) FROM cache WHERE data IS NULL").fetchone()[0] == 5
+    conn.close()
+
+def test_changed_stored_data(tmp_path, stub_server):
+    plugin, fetcher_cls = make_plugin(tmp_path, stub_server, 2)
+    plugin.enable_http_cache()
+    fetch(plugin, fetcher_cls, "threads")
+    fetcher_cls(plugin).reset()
+    conn = sqlite3.connect(plugin.output_db)
+    conn.execute("UPDATE raw SET data='other', data_hash=NULL WHERE id=1")
+    conn.commit()
+    conn.close()
+    _, rows = fetch(plugin, fetcher_cls, "threads")
+    # without the cached page, only the unmodified row can be revalidated
+    assert stub_server.bodies == 3
+    assert rows[0][2] == b"<P>/ETAG/0</P>"
+
+def test_reset_with_bodies(tmp_path, stub_server):
+    plugin, fetcher_cls = make_plugin(tmp_path, stub_server, 3)
+    plugin.enable_http_cache(keep_bodies=True)
+    _, rows = fetch(plugin, fetcher_cls, "threads")
+    plugin.reset()
+    plugin, fetcher_cls = make_plugin(tmp_path, stub_server, 3)
+    plugin.enable_http_cache(keep_bodies=True)
+    _, refetched = fetch(plugin, fetcher_cls, "threads")
+    assert stub_server.bodies == 3
+    assert plugin.http_cache.unchanged == 3
+    assert [row[2] for row in refetched] == [row[2] for row in rows]
+
+def test_stored_digests_batches(tmp_path):
+    plugin = BasePlugin(str(tmp_path))
+    conn = sqlite3.connect(plugin.output_db)
+    conn.executemany("INSERT INTO raw(uri,data,data_hash,flag) VALUES (?,?,?,?)",
+                     [(str(i), "x", None if i % 3 else bytes([i]), FLAGS["RAW_FETCHER"])
+                      for i in range(1, 11)])
+    conn.commit()
+    conn.close()
+    stored = StoredDigests(plugin.output_db, [(i, str(i)) for i in range(1, 11)])
+    stored.batch_size = 4
+    digests = []
+    for i in range(1, 11):
+        digests.append(stored.get(i))
+        assert len(stored._batch) <= 4
+    assert digests == [bytes([i]) if i % 3 == 0 else None for i in range(1, 11)]
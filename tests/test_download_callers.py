@@ -0,0 +1,16 @@
+import types
+
+from pyquery import PyQuery as pq
+
+from dictmaster.util import RetriesExhausted
+from dictmaster.plugins.zeno import ZenoProcessor
+
+def test_zeno_skips_unavailable_images(tmp_path):
+    def download_retry(url, *args, **kwargs):
+        raise RetriesExhausted(url)
+    proc = ZenoProcessor.__new__(ZenoProcessor)
+    proc.plugin = types.SimpleNamespace(output_directory=str(tmp_path))
+    proc.download_retry = download_retry
+    doc = pq('<div><p><img src="/a/b.png"/>x</p></div>')
+    proc._download_res(doc)
+    assert doc("img").attr("src") == "/a/b.png"
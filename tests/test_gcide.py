@@ -0,0 +1,169 @@
+import re
+import random
+import sqlite3
+
+import pytest
+from lxml import etree
+from lxml.html import defs as html_defs
+from pyquery import PyQuery as pq
+
+from dictmaster.util import FLAGS
+from dictmaster.plugin import BasePlugin
+from dictmaster.plugins.gcide import GcideProcessor, entities, greek_translit, \
+    gcide_grk_to_utf8, xlit
+
+def old_html_definition(proc, html):
+    """ The rewriter before it worked in place, one family of tags after the other """
+    d = pq(html)
+    for e in html.find("entity"):
+        d(e).replaceWith(entities.get(d(e).text(), ""))
+    for u in html.find("unicode"):
+        d(u).replaceWith(chr(int(d(u).text(), 16)))
+    for g in html.find("grk"):
+        d(g).replaceWith(greek_translit(d(g).text()))
+    for sel, tag, color, strip in [
+        ("hw", "b", "#00b", True),
+        ("wf", "span", "#00b", True),
+        ("pr", "i", None, True),
+        ("q", "i", "#33f", False),
+        ("pos,pluf", "i", "#a00", False),
+        ("mark,fld,conjf,plw,adjf,altname,sig,usedfor", "span", "#00b", False),
+        ("as", "span", "33a", False),
+        ("ets,spn,gen,stype", "span", "#8B4513", False),
+    ]:
+        for el in html.find(sel):
+            inner = d(el).html()
+            if strip:
+                inner = proc.strip_quotes.sub(inner)
+            new = d("<%s/>" % tag)
+            if color is not None:
+                new = new.css("color", color)
+            d(el).replaceWith(new.html(inner).outerHtml())
+    for er in html.find("er"):
+        href = d(er).text().strip()
+        if href == "":
+            d(er).replaceWith("")
+        else:
+            href = href.split(" ")[0]
+            d(er).replaceWith(
+                d("<a/>").attr("href", "bword://%s" % href).html(d(er).html()).outerHtml()
+            )
+    for src in html.find("source"):
+        d(src).replaceWith("")
+    return "<p>%s</p>" % html.html().strip()
+
+def expand_empty(html):
+    """ `<b/>` -> `<b></b>`, the old rewriter emitted both """
+    return re.sub(r"<([a-z]+)((?: [^<>]*?)?)/>", lambda m: m.group(0)
+                  if m.group(1) in html_defs.empty_tags
+                  else "<%s%s></%s>" % (m.group(1), m.group(2), m.group(1)), html)
+
+def parse(proc, raw):
+    data = proc.do_pre_html(("<p>%s</p>" % raw).encode("windows-1252"))
+    doc = pq(etree.fromstring(data, parser=etree.HTMLParser(encoding="windows-1252")))
+    return doc("p")
+
+@pytest.fixture
+def proc():
+    return GcideProcessor.__new__(GcideProcessor)
+
+@pytest.mark.parametrize("raw", [
+    "<wf>'<er></er></wf>",
+    "<hw>'</hw> <pr>\"</pr>",
+    "<q></q><pos> </pos>",
+    "<hw>Ab*a`cus</hw>, <wf>don't</wf>",
+    "<q>x <q>y</q> z</q>",
+    "<er>foo bar</er> <er> </er> <er>\\'e9t\\'e9</er>",
+    "<hw><er>a'b</er></hw>",
+    "<pos><er>a</er><source>b</source></pos>",
+    "<er>x<source>y</source></er>",
+    "<source>Webster 1913</source> <grk>lo`gos</grk> <eacute/ <nosuch/",
+    "<ets>L. <grk>qeo`s</grk><br/ <spn>god</spn></ets>",
+    "<as>as in the phrases <er>x y</er></as>",
+    "<mark><fld><usedfor>'</usedfor></fld></mark><sd>a</sd>",
+    "<hw>a<wf>b</wf>'<pr>'</pr></hw>",
+])
+def test_html_definition(proc, raw):
+    new = proc.do_html_definition(None, parse(proc, raw), "")
+    old = old_html_definition(proc, parse(proc, raw))
+    assert new == expand_empty(old)
+    tags = {t for t in re.findall(r"<([a-z]+)[^<>]*/>", new)}
+    assert tags <= html_defs.empty_tags
+
+def test_html_definition_emptied(proc):
+    html = parse(proc, "<wf>'<er></er></wf>")
+    assert proc.do_html_definition(None, html, "") == '<p><span style="color: #00b"></span></p>'
+
+def old_grk_to_utf8(grk_str):
+    """ The transliteration before it was looked up in a trie """
+    found_len = 0
+    found_xlit = None
+    if grk_str == "s":
+        return (1, "ς")
+    for p in xlit:
+        i = 0
+        while i < min(len(grk_str), len(p[0])) and p[0][i] == grk_str[i]:
+            i += 1
+        if i < len(p[0]):
+            if found_len > 0 and i == 0:
+                break
+            continue
+        if i > found_len:
+            found_len = i
+            found_xlit = p
+    if found_len:
+        return (found_len, found_xlit[1])
+    return (None, None)
+
+def old_greek_translit(grk_str):
+    result = ""
+    n = 0
+    while len(grk_str) > n:
+        gr_len, greek = old_grk_to_utf8(grk_str[n:])
+        if greek:
+            result += greek
+            n += gr_len
+        else:
+            result += grk_str[n]
+            n += 1
+    return result
+
+@pytest.mark.parametrize("grk_str", [
+    "", "s", "ss", "os", "'A", "'A~", "'A~,", "'A~,x", "'A~s", "'Ax",
+    "'", "'`", "'`O", "A", "a,", "'A`nqrwpos", "lo`gos", "qeo`s", "a'i^", "?",
+])
+def test_grk_to_utf8(grk_str):
+    assert gcide_grk_to_utf8(grk_str) == old_grk_to_utf8(grk_str)
+    assert greek_translit(grk_str) == old_greek_translit(grk_str)
+
+def test_greek_translit_random():
+    rnd = random.Random(1)
+    keys = [latin for latin, _ in xlit]
+    alphabet = sorted(set("".join(keys))) + ["s"]
+    for _ in range(2000):
+        if rnd.random() < 0.5:
+            grk_str = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12)))
+        else:
+            grk_str = "".join(rnd.choice(keys) for _ in range(rnd.randint(0, 5)))
+            grk_str += rnd.choice(["", "s"])
+        assert greek_translit(grk_str) == old_greek_translit(grk_str)
+
+def test_grk_longest_match():
+    # "'A", "'A~" and "'A~," are all transliterated
+    assert gcide_grk_to_utf8("'A~,x") == (4, "ᾊ")
+    assert gcide_grk_to_utf8("'A~x") == (3, "Ἂ")
+    assert greek_translit("lo`gos") == "\u03bb\u1f79\u03b3\u03bf\u03c2"
+
+def test_rows_independent(tmp_path):
+    plugin = BasePlugin(str(tmp_path))
+    conn = sqlite3.connect(plugin.output_db)
+    conn.executemany("INSERT INTO raw(uri, data, flag) VALUES (?,?,?)", [
+        ("CIDE.A", b"<p><hw>a</hw> first</p>", FLAGS["FETCHED"]),
+        ("CIDE.B", b"<p>no headword</p><p><hw>b</hw> second</p>", FLAGS["FETCHED"]),
+    ])
+    conn.commit()
+    proc = GcideProcessor("p", plugin, charset="windows-1252", auto_synonyms=False)
+    proc.run()
+    entries = conn.execute("SELECT word, rawid FROM dict ORDER BY id").fetchall()
+    conn.close()
+    assert entries == [("a", 1), ("b", 2)]
@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+
+import dictmaster.plugin
+from dictmaster.plugin import BasePlugin
+from dictmaster.util import data_hash
+
+ENTRIES = [
+    ("a", "1"), ("b", "2"), ("a", "3"), ("c", "4"), ("a", "5"), ("b", "6"),
+]
+
+def make_plugin(tmp_path, entries=ENTRIES):
+    plugin = BasePlugin(str(tmp_path))
+    conn = sqlite3.connect(plugin.output_db)
+    conn.executemany("INSERT INTO dict(word,def,def_hash) VALUES (?,?,?)",
+                     [(word, definition, data_hash(definition)) for word, definition in entries])
+    conn.executemany("INSERT INTO synonyms(wid,syn) VALUES (?,?)",
+                     [(i + 1, "s" + word) for i, (word, _) in enumerate(entries)])
+    conn.commit()
+    conn.close()
+    return plugin
+
+def optimized(plugin, enumerate):
+    plugin.optimize_data(enumerate=enumerate)
+    conn = sqlite3.connect(plugin.output_db)
+    words = conn.execute("SELECT id, word, def FROM dict ORDER BY id").fetchall()
+    syns = conn.execute("SELECT wid, syn FROM synonyms ORDER BY wid, syn").fetchall()
+    conn.close()
+    return words, syns
+
+@pytest.mark.parametrize("update_from", [True, False])
+def test_dupidx_enumerate(tmp_path, monkeypatch, update_from):
+    monkeypatch.setattr(dictmaster.plugin, "UPDATE_FROM", update_from)
+    words, syns = optimized(make_plugin(tmp_path), True)
+    assert words == [(1, "a(1)", "1"), (2, "b(1)", "2"), (3, "a(2)", "3"),
+                     (4, "c", "4"), (5, "a(3)", "5"), (6, "b(2)", "6")]
+    assert syns == [(1, "a"), (1, "sa"), (2, "b"), (2, "sb"), (3, "a"), (3, "sa"),
+                    (4, "sc"), (5, "a"), (5, "sa"), (6, "b"), (6, "sb")]
+
+@pytest.mark.parametrize("update_from", [True, False])
+def test_dupidx_cat(tmp_path, monkeypatch, update_from):
+    monkeypatch.setattr(dictmaster.plugin, "UPDATE_FROM", update_from)
+    words, syns = optimized(make_plugin(tmp_path), False)
+    assert words == [(1, "a", "135"), (2, "b", "26"), (4, "c", "4")]
+    assert syns == [(1, "sa"), (2, "sb"), (4, "sc")]
+
+@pytest.mark.parametrize("update_from", [True, False])
+def test_dupentries_remove(tmp_path, monkeypatch, update_from):
+    monkeypatch.setattr(dictmaster.plugin, "UPDATE_FROM", update_from)
+    plugin = make_plugin(tmp_path, [("a", "1"), ("b", "1"), ("a", "1"), ("a", "2")])
+    plugin._conn = sqlite3.connect(plugin.output_db)
+    plugin._c = plugin._conn.cursor()
+    plugin.dupentries_remove()
+    words = plugin._c.execute("SELECT id, word, def FROM dict ORDER BY id").fetchall()
+    syns = plugin._c.execute("SELECT wid, syn FROM synonyms ORDER BY id").fetchall()
+    plugin._conn.close()
+    assert words == [(2, "b", "1"), (3, "a", "1"), (4, "a", "2")]
+    assert syns == [(3, "sa"), (2, "sb"), (3, "sa"), (4, "sa")]
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import sqlite3
+
+import pytest
+
+from dictmaster.util import FLAGS
+from dictmaster.plugin import BasePlugin
+from dictmaster.stages.processor import Processor, DictfileProcessor
+
+class LinesProcessor(Processor):
+    def process(self):
+        self.pids.add(os.getpid())
+        for line in self._curr_row["data"].splitlines():
+            term, definition = line.split(":")
+            self.append(term, definition)
+
+class LinesFileProcessor(DictfileProcessor):
+    def process(self):
+        self.pids.add(os.getpid())
+        super().process()
+
+def make_plugin(tmp_path, rows):
+    plugin = BasePlugin(str(tmp_path))
+    conn = sqlite3.connect(plugin.output_db)
+    conn.executemany("INSERT INTO raw(uri, data, flag) VALUES (?,?,?)", rows)
+    conn.commit()
+    conn.close()
+    return plugin
+
+def run(proc):
+    proc.pids = set()
+    proc.run()
+    conn = sqlite3.connect(proc.plugin.output_db)
+    entries = conn.execute("SELECT id, word, def, rawid FROM dict ORDER BY id").fetchall()
+    conn.close()
+    return entries
+
+def test_parallel_same_result(tmp_path):
+    rows = [(f"p{i}", "\n".join(f"w{i}{j}:d{i}{j}" for j in range(3)), FLAGS["FETCHED"])
+            for i in range(120)]
+    serial = run(LinesProcessor(make_plugin(tmp_path / "serial", rows), auto_synonyms=False))
+    proc = LinesProcessor(make_plugin(tmp_path / "parallel", rows), auto_synonyms=False,
+                          processes=2)
+    assert run(proc) == serial
+    assert len(serial) == 360
+
+def test_stream_files_serial(tmp_path):
+    path = tmp_path / "dump.txt"
+    path.write_text("".join(f"w{i}:d{i}\n" for i in range(100)))
+    plugin = make_plugin(tmp_path / "out", [(str(path), None, FLAGS["FILE"])])
+    proc = LinesFileProcessor(plugin, fieldSplit=":")
+    proc.auto_synonyms, proc.processes = False, 2
+    assert len(run(proc)) == 100
+    assert proc.pids == {os.getpid()}
+
+class PidProcessor(Processor):
+    def process(self):
+        time.sleep(0.02)
+        self.append(self._curr_row["uri"], str(os.getpid()))
+
+def test_batches(tmp_path):
+    rows = [(i, f"p{i}", None, FLAGS["FILE"] if i in (3, 4) else 0) for i in range(8)]
+    proc = Processor(make_plugin(tmp_path, []))
+    batches = [[row[0] for row in batch] for batch in proc.batches(iter(rows), 2)]
+    assert batches == [[0, 1], [2], [3], [4], [5, 6], [7]]
+
+def test_parallel_file_rows(tmp_path):
+    # like the CIDE.A-Z files of GCIDE, fewer rows than Processor.batch_size
+    rows = []
+    for i in range(26):
+        path = tmp_path / f"CIDE.{chr(65 + i)}"
+        path.write_text("")
+        rows.append((str(path), None, FLAGS["FILE"]))
+    proc = PidProcessor(make_plugin(tmp_path / "out", rows), auto_synonyms=False,
+                        processes=2)
+    entries = run(proc)
+    assert [e[1] for e in entries] == [r[0] for r in rows]
+    assert len({e[2] for e in entries}) == 2
+
+class FailingProcessor(Processor):
+    def process(self):
+        if self._curr_row["uri"] == "p7":
+            self.fail()
+        self.append(self._curr_row["uri"], "d")
+
+class ExitProcessor(FailingProcessor):
+    # like the debugging leftovers in gcide and zeno
+    def fail(self): sys.exit()
+
+class RaiseProcessor(FailingProcessor):
+    def fail(self): raise ValueError("broken page")
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_parallel_exit(tmp_path):
+    rows = [(f"p{i}", "", FLAGS["FETCHED"]) for i in range(20)]
+    proc = ExitProcessor(make_plugin(tmp_path, rows), auto_synonyms=False, processes=2)
+    proc.start()
+    proc.join(10)
+    assert not proc.is_alive()
+
+def test_parallel_raise(tmp_path):
+    rows = [(f"p{i}", "", FLAGS["FETCHED"]) for i in range(20)]
+    proc = RaiseProcessor(make_plugin(tmp_path, rows), auto_synonyms=False, processes=2)
+    with pytest.raises(ValueError, match="broken page"):
+        proc.run()
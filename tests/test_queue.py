@@ -0,0 +1,36 @@
+import sqlite3
+
+from dictmaster.util import FLAGS, data_hash
+from dictmaster.plugin import BasePlugin
+from dictmaster.queue import RawDbQueue
+
+def make_queue(tmp_path, rows):
+    plugin = BasePlugin(str(tmp_path))
+    queue = RawDbQueue(plugin.output_db)
+    queue.reload_duplicates = True
+    queue._conn = sqlite3.connect(plugin.output_db)
+    queue._c = queue._conn.cursor()
+    queue._c.executemany("INSERT INTO raw(id,uri,data,data_hash,flag) VALUES (?,?,?,?,?)",
+                         [(rawid, uri, data, data_hash(data), flag)
+                          for rawid, uri, data, flag in rows])
+    queue._conn.commit()
+    return queue
+
+def test_reload_duplicates_batched(tmp_path):
+    # like zeno: a page that is fetched again is reloaded, the next one kept
+    fetched = FLAGS["RAW_FETCHER"] | FLAGS["FETCHED"]
+    rows = [(1, "a", None, FLAGS["RAW_FETCHER"]), (2, "b", None, FLAGS["RAW_FETCHER"]),
+            (5, "c", b"A", fetched)]
+    items = [(1, "a", b"A", fetched), (2, "b", b"A", fetched)]
+    results = []
+    for batched in (True, False):
+        queue = make_queue(tmp_path / str(batched), rows)
+        if batched:
+            queue.process_batch(items)
+        else:
+            for item in items:
+                queue.process_item(item)
+        results.append(queue._c.execute("SELECT * FROM raw ORDER BY id").fetchall())
+        queue._conn.close()
+    assert results[0] == results[1]
+    assert [(row[0], row[2]) for row in results[0]] == [(1, None), (2, b"A"), (5, None)]
@@ -0,0 +1,50 @@
+import re
+import random
+
+from pyquery import PyQuery as pq
+
+from dictmaster.replacer import RegexPipeline, doc_replace_els, doc_rewrap_els
+
+def test_replace_els_empty_selection():
+    doc = pq([])
+    doc_replace_els(doc, "b", lambda el: "<i>x</i>")
+    doc_rewrap_els(doc, "b", "<i/>")
+    assert len(doc) == 0
+
+def test_replace_els_nested():
+    doc = pq("<div><b>a<b>b</b></b><b>c</b></div>")
+    doc_rewrap_els(doc, "b", "<i/>")
+    assert doc.outer_html() == "<div><i>a<i>b</i></i><i>c</i></div>"
+
+def test_regex_pipeline():
+    rules = [
+        [r"<br/?>", "\n"],
+        ["ab", "b"],
+        ["b", "ab"],
+        [r"(?i)<(/?)em>", r"<\1i>"],
+        ["&", "&amp;"],
+        ["", "-"],
+    ]
+    string = "abba<br><EM>x</em><br/>&"
+    expected = string
+    for pattern, repl in rules:
+        expected = re.sub(pattern, repl, expected)
+    assert RegexPipeline(rules).sub(string) == expected
+
+def loop_sub(rules, string):
+    for pattern, repl in rules:
+        string = re.sub(pattern, repl, string)
+    return string
+
+def test_regex_pipeline_random():
+    rnd = random.Random(1)
+    for _ in range(2000):
+        rules = [["".join(rnd.choice("abc") for _ in range(rnd.randint(1, 3))),
+                  "".join(rnd.choice("abcxy") for _ in range(rnd.randint(0, 2)))]
+                 for _ in range(rnd.randint(1, 5))]
+        string = "".join(rnd.choice("abcx") for _ in range(rnd.randint(0, 20)))
+        assert RegexPipeline(rules).sub(string) == loop_sub(rules, string)
+
+def test_regex_pipeline_callable():
+    pipeline = RegexPipeline([["ab", lambda m: m.group(0).upper()]])
+    assert pipeline.sub("xaby") == "xABy"
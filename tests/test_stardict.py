@@ -0,0 +1,25 @@
+import gzip
+import os
+
+from dictmaster import stardict
+from dictmaster.stardict import StarDictWriter
+
+ENTRIES = [("a%d" % i, "definition %d " % i * 10) for i in range(200)]
+
+def test_dictzip(tmp_path):
+    basename = str(tmp_path / "stardict")
+    writer = StarDictWriter(basename, "test", dictzip_chunk_size=1000)
+    writer.write(ENTRIES, [])
+    assert not os.path.exists(basename + ".dict")
+    with gzip.open(basename + ".dict.dz") as f:
+        assert f.read() == "".join(d for _, d in ENTRIES).encode()
+
+def test_dictzip_too_big(tmp_path, monkeypatch):
+    monkeypatch.setattr(stardict, "DICTZIP_MAX_CHUNKS", 4)
+    basename = str(tmp_path / "stardict")
+    writer = StarDictWriter(basename, "test", dictzip_chunk_size=1000)
+    writer.write(ENTRIES, [])
+    assert not os.path.exists(basename + ".dict.dz")
+    with open(basename + ".dict", "rb") as f:
+        assert f.read() == "".join(d for _, d in ENTRIES).encode()
+    assert os.path.exists(basename + ".ifo")
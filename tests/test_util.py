@@ -0,0 +1,95 @@
+import time
+from urllib.error import HTTPError
+
+import pytest
+
+from dictmaster.util import ConnectionPool, CancelableThread, RetryPolicy, RetriesExhausted
+from dictmaster.stages.fetcher import ConcurrencyController
+
+class RecordingPool(ConnectionPool):
+    """ Keeps track of the connections it hands out """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.conns = []
+
+    def _get(self, key, timeout):
+        conn, reused = super()._get(key, timeout)
+        self.conns.append(conn)
+        return conn, reused
+
+def test_connection_reused(stub_server, no_proxy):
+    pool = ConnectionPool()
+    for path in ("/a", "/b"):
+        response = pool.urlopen(stub_server.url + path)
+        assert response.read() == ("<p>%s</p>" % path).encode()
+        pool.release(response)
+    assert (pool.requests, pool.reused) == (2, 1)
+    assert stub_server.connections == 1
+
+def test_connection_discarded_after_failed_read(stub_server, no_proxy):
+    pool = RecordingPool()
+    thread = CancelableThread(sleep=(0, 0), pool=pool,
+                              retry_policy=RetryPolicy(max_attempts=1))
+    with pytest.raises(RetriesExhausted):
+        thread.download_retry(stub_server.url + "/truncated")
+    assert len(pool.conns) == 1
+    assert pool.conns[0].sock is None
+    assert pool._idle == {}
+
+def test_failed_download_to_file(stub_server, no_proxy, tmp_path):
+    thread = CancelableThread(sleep=(0, 0), pool=ConnectionPool(),
+                              retry_policy=RetryPolicy(max_attempts=1))
+    with pytest.raises(RetriesExhausted):
+        thread.download_retry(stub_server.url + "/truncated", dest=str(tmp_path / "a.zip"))
+    assert list(tmp_path.iterdir()) == []
+
+def test_redirect_loop(stub_server, no_proxy):
+    pool = ConnectionPool()
+    with pytest.raises(HTTPError):
+        pool.urlopen(stub_server.url + "/loop")
+    idle = [conn for conns in pool._idle.values() for conn in conns]
+    assert len(idle) == len(set(idle)) == 1
+
+def test_proxy(stub_server, no_proxy, monkeypatch):
+    monkeypatch.setenv("http_proxy", stub_server.url)
+    pool = ConnectionPool()
+    url = "http://dictmaster.invalid/a"
+    response = pool.urlopen(url)
+    # the stub server echoes the absolute URL sent to a proxy
+    assert response.read() == ("<p>%s</p>" % url).encode()
+    pool.release(response)
+    assert pool.requests == 0
+
+def test_round_delay_cap():
+    policy = RetryPolicy(max_attempts=2, max_delay=5.0)
+    sleep = (20.0, 20.0)
+    assert policy.delay(1, sleep) == 20.0
+    assert policy.round_delay(1, sleep) == 20.0
+    assert RetryPolicy(max_delay=5.0).round_delay(1, (1.0, 1.0)) == 5.0
+
+class ThrottledPool(ConnectionPool):
+    """ Answers every request with 503, records the controller's active workers """
+    def __init__(self, controller):
+        super().__init__()
+        self.controller, self.active = controller, []
+
+    def urlopen(self, url, data=None, timeout=60, headers=None):
+        self.active.append(self.controller.active)
+        raise HTTPError(url, 503, "Service Unavailable", None, None)
+
+def test_slot_released_during_backoff(monkeypatch):
+    controller = ConcurrencyController(1, 1)
+    pool = ThrottledPool(controller)
+    thread = CancelableThread(sleep=(2.0, 2.0), pool=pool, controller=controller,
+                              retry_policy=RetryPolicy(max_attempts=2))
+    sleeping = []
+    monkeypatch.setattr(time, "sleep", lambda t: sleeping.append(controller.active))
+    slot = controller.slot()
+    assert slot.acquire(thread)
+    with pytest.raises(RetriesExhausted):
+        thread.download_retry("http://dictmaster.invalid/a", slot=slot)
+    assert pool.active == [1, 1]
+    assert sleeping == [0, 0]
+    assert slot.held
+    slot.release()
+    assert controller.active == 0